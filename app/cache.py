@@ -0,0 +1,70 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+# Every cache of the API, to clear them all when Odoo signals its own caches
+# must be invalidated.
+_caches = weakref.WeakSet()
+_cache_sequence = None
+
+
+class TTLCache:
+    """Thread-safe, size bounded LRU cache whose entries expire after `ttl` seconds"""
+
+    def __init__(
+        self, maxsize: int = 1024, ttl: float = 60.0, clear_on_signaling: bool = True
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        if clear_on_signaling:
+            _caches.add(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                return default
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard_if(self, predicate: Callable[[Hashable], bool]) -> None:
+        """Remove the entries whose key matches `predicate`"""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+def check_cache_signaling(registry) -> None:
+    """Clear every cache when Odoo signaled that its caches were invalidated.
+
+    Must be called after `registry.check_signaling()`, which picks up the
+    invalidations made by the other Odoo processes.
+    """
+    global _cache_sequence
+    if registry.cache_sequence == _cache_sequence:
+        return
+    for cache in list(_caches):
+        cache.clear()
+    _cache_sequence = registry.cache_sequence
@@ -3,11 +3,14 @@
 # - https://fastapi.tiangolo.com/tutorial/bigger-applications/
 # - https://fastapi.tiangolo.com/advanced/security/oauth2-scopes/
 import contextlib
+import hashlib
 import logging
 import os
+import threading
+import time
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List, Optional
+from typing import List, NamedTuple, Optional
 
 import odoo
 from dotenv import load_dotenv
@@ -18,6 +21,8 @@ from odoo.api import Environment
 from passlib.context import CryptContext
 from pydantic import BaseModel
 
+from . import executor
+from .cache import TTLCache, check_cache_signaling
 from .settings import SETTINGS
 
 logger = logging.getLogger(__name__)
@@ -41,30 +46,77 @@ def is_docker():
     )
 
 
-def odoo_env() -> Environment:
+def configure_odoo():
+    """Adapt the parsed Odoo configuration to where the API runs. Call once at startup."""
+    # HACK: when running API outside of docker network where Odoo is running
+    if odoo.tools.config["db_host"] == "host.docker.internal" and is_docker() is False:
+        odoo.tools.config["db_host"] = "0.0.0.0"
+        if "DEV_ADDONS_PATH" in os.environ:
+            odoo.tools.config["addons_path"] += "," + os.environ["DEV_ADDONS_PATH"]
+
+
+# Checking the signaling costs a cursor and a query, do it at most that often.
+SIGNALING_INTERVAL = float(SETTINGS.get("ODOO_SIGNALING_INTERVAL_SECONDS", "1"))
+_last_signaling_check = 0.0
+
+# Odoo user context (lang, tz, ...) by user id
+context_cache = TTLCache(
+    maxsize=int(SETTINGS.get("CONTEXT_CACHE_MAX_SIZE", "1024")),
+    ttl=int(SETTINGS.get("CONTEXT_CACHE_TTL_SECONDS", "300")),
+)
+
+
+def get_registry():
+    """Registry of the configured database, refreshed from the signaling when due"""
+    global _last_signaling_check
+    registry = odoo.registry(odoo.tools.config["db_name"])
+    now = time.monotonic()
+    if now - _last_signaling_check >= SIGNALING_INTERVAL:
+        _last_signaling_check = now
+        # check_signaling() is to refresh the registry and cache when needed.
+        registry = registry.check_signaling()
+        check_cache_signaling(registry)
+    return registry
+
+
+def get_user_context(cr, uid: int) -> dict:
+    ctx = context_cache.get(uid)
+    if ctx is None:
+        try:
+            ctx = Environment(cr, uid, {})["res.users"].context_get()
+        except odoo.exceptions.UserError:
+            # Database errors propagate: the transaction can't be used anyway
+            logger.exception("[!] Cannot read the context of user %s", uid)
+            return {"lang": "en_US"}
+        context_cache.set(uid, ctx)
+    return ctx
+
+
+def _open_odoo_env() -> Environment:
     #
     # /!\ With Odoo < 15 you need to wrap all this in 'with
     #     Environment.manage()' and apply this Odoo patch:
     #     https://github.com/odoo/odoo/pull/70398, to properly handle context
     #     locals in an async program.
     #
-    # check_signaling() is to refresh the registry and cache when needed.
-    # HACK: when running API outside of docker network where Odoo is running
-    if odoo.tools.config["db_host"] == "host.docker.internal" and is_docker() is False:
-        odoo.tools.config["db_host"] = "0.0.0.0"
-        if "DEV_ADDONS_PATH" in os.environ:
-            odoo.tools.config["addons_path"] += "," + os.environ["DEV_ADDONS_PATH"]
-    registry = odoo.registry(odoo.tools.config["db_name"]).check_signaling()
+    registry = get_registry()
+    # Odoo logging and tools look for the database of the thread
+    threading.current_thread().dbname = registry.db_name
     # manage_change() is to signal other instances when the registry or cache
     # needs refreshing.
     with registry.manage_changes():
         # The cursor context manager commits unless there is an exception.
         with registry.cursor() as cr:
-            try:
-                ctx = Environment(cr, odoo.SUPERUSER_ID, {})["res.users"].context_get()
-            except Exception as e:
-                ctx = {"lang": "en_US"}
+            ctx = get_user_context(cr, odoo.SUPERUSER_ID)
             yield Environment(cr, odoo.SUPERUSER_ID, ctx)
+            logger.debug("[.] %s queries", cr.sql_log_count)
+
+
+def odoo_env(
+    # Not shared: each environment of the request takes a slot of its own
+    cursor_slot: None = Depends(executor.request_cursor_slot, use_cache=False),
+) -> Environment:
+    yield from _open_odoo_env()
 
 
 # AUTHENTICATION
@@ -88,6 +140,7 @@ ALGORITHM = "HS256"
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
 
 
 class TokenData(BaseModel):
@@ -105,6 +158,7 @@ class User(BaseModel):
 
 class UserInDB(User):
     hashed_password: str
+    id: Optional[int] = None
 
 
 class ImproperlyConfigured(Exception):
@@ -126,6 +180,41 @@ oauth2_scheme = OAuth2PasswordBearer(
 )
 
 
+# Successful API key verifications, keyed by (username, API key digest).
+# Verifying an API key is a full passlib hash; the TTL bounds how long a key
+# revoked from another process (or from Odoo) keeps working.
+credentials_cache = TTLCache(
+    maxsize=int(SETTINGS.get("AUTH_CACHE_MAX_SIZE", "1024")),
+    ttl=int(SETTINGS.get("AUTH_CACHE_TTL_SECONDS", "60")),
+)
+
+
+def credentials_cache_key(username: str, odoo_access_token: str):
+    # Never keep the API key itself in memory
+    digest = hashlib.sha256(odoo_access_token.encode()).hexdigest()
+    return username, digest
+
+
+def invalidate_credentials(username: str):
+    """Forget the verified API keys of the user, e.g. when revoked or regenerated"""
+    credentials_cache.discard_if(lambda key: key[0] == username)
+
+
+def verify_credentials(username: str, odoo_access_token: str) -> Optional[UserInDB]:
+    """User of the API key, checked against Odoo once per AUTH_CACHE_TTL_SECONDS.
+
+    Raises APIAccessTokenDoesNotExist or UserWithAccessTokenDoesNotExist when
+    the key is not valid.
+    """
+    cache_key = credentials_cache_key(username, odoo_access_token)
+    user = credentials_cache.get(cache_key)
+    if user is None:
+        user, __ = get_odoo_user(username=username, odoo_access_token=odoo_access_token)
+        if user is not None:
+            credentials_cache.set(cache_key, user)
+    return user
+
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
@@ -153,7 +242,9 @@ def get_user(db, username: str):
 
 @contextlib.contextmanager
 def get_odoo_env():
-    yield from odoo_env()
+    """Odoo environment outside of the request dependencies"""
+    with executor.cursor_slot():
+        yield from _open_odoo_env()
 
 
 class UserWithAccessTokenDoesNotExist(Exception):
@@ -199,6 +290,7 @@ def get_odoo_user(username: str = None, odoo_access_token: Optional[str] = None)
                 full_name=user.name,
                 disabled=not user.active,
                 hashed_password="",
+                id=user.id,
             ),
             user,
         )
@@ -214,6 +306,10 @@ def authenticate_user(username: str, password: str):
     return user
 
 
+# `type` claim of the refresh tokens. Access tokens have none.
+REFRESH_TOKEN_TYPE = "refresh"
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -225,7 +321,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-async def get_current_user(
+def get_current_user(
     security_scopes: SecurityScopes,
     token: str = Depends(oauth2_scheme),
 ):
@@ -242,6 +338,9 @@ async def get_current_user(
     )
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        if payload.get("type") == REFRESH_TOKEN_TYPE:
+            # Only good for getting a new access token
+            raise credentials_exception
         username, odoo_access_token = payload.get("sub", "").split("|", maxsplit=1)
         if odoo_access_token is None or username is None:
             raise credentials_exception
@@ -260,9 +359,7 @@ async def get_current_user(
         )
     # user = get_user(fake_users_db, username=token_data.username)
     try:
-        user, __ = get_odoo_user(
-            username=token_data.username, odoo_access_token=odoo_access_token
-        )
+        user = verify_credentials(token_data.username, odoo_access_token)
     except APIAccessTokenDoesNotExist:
         # Revoked/deleted in Odoo
         raise HTTPException(
@@ -295,3 +392,31 @@ async def get_current_active_user(
     if current_user.disabled:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
+
+
+class Principal(NamedTuple):
+    """Authenticated user of the request, bound to the request Odoo environment"""
+
+    user: User
+    odoo_user: odoo.models.Model
+    env: Environment
+
+
+async def get_current_principal(
+    # Dependencies are solved in order: authenticate before taking a cursor,
+    # so that rejected requests never open one.
+    current_user: UserInDB = Depends(get_current_active_user),
+    env: Environment = Depends(odoo_env),
+) -> Principal:
+    """Resolve the Odoo user once, on the cursor of the request.
+
+    Route handlers should take the environment from the principal instead of
+    depending on `odoo_env` themselves: FastAPI does not share dependencies
+    requested under different security scopes, so that would open another
+    cursor.
+    """
+    return Principal(
+        user=current_user,
+        odoo_user=env["res.users"].browse(current_user.id),
+        env=env,
+    )
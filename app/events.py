@@ -0,0 +1,242 @@
+"""Changes of the unassigned orders, pushed to the drivers.
+
+A trigger on `stock_picking`, created by `sql/order_events.sql` when
+deploying, notifies the changes of picking state and responsible on a
+Postgres channel. Each API process listens to it on a single connection,
+from a thread, and hands the changes to the event loop, which turns them
+into events for every subscriber (see `GET /orders/events`).
+
+Events are numbered by a database sequence, in the trigger, and every
+process receives them in the same order: a client reconnecting to any
+process with the id of the last event it received gets the events that
+followed, among the last ones that process kept. When they are no longer
+kept, or the process was not listening yet, the client is told to `reset`
+instead.
+"""
+import asyncio
+import json
+import logging
+import select
+import threading
+import uuid
+from collections import deque
+from typing import List, Optional, Set
+
+import odoo
+import psycopg2
+
+from .settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "nextway_api_picking"
+HEARTBEAT_SECONDS = float(SETTINGS.get("ORDER_EVENTS_HEARTBEAT_SECONDS", "15"))
+# Streams end after that long, and clients reconnect (to any worker) with the
+# id of their last event. Keeps a server shutdown from waiting for them.
+MAX_STREAM_SECONDS = float(SETTINGS.get("ORDER_EVENTS_MAX_STREAM_SECONDS", "300"))
+RECONNECT_MILLISECONDS = 3000
+HISTORY_SIZE = int(SETTINGS.get("ORDER_EVENTS_HISTORY_SIZE", "1000"))
+# Events waiting to be sent to a client. A client that far behind is dropped.
+QUEUE_SIZE = 100
+
+
+def is_unassigned(state: Optional[str], user_id: Optional[int]) -> bool:
+    """Same as the `unassigned` filter of `picking_state_domain`"""
+    return not state or (state == "assigned" and not user_id)
+
+
+def order_event(change: dict) -> Optional[dict]:
+    """Event of a picking change, if it changes the unassigned orders"""
+    if not change["sale_id"]:
+        return None
+    was = change["existed"] and is_unassigned(
+        change["old_state"], change["old_user_id"]
+    )
+    now = change["exists"] and is_unassigned(change["state"], change["user_id"])
+    if was == now:
+        return None
+    if now:
+        event = "added"
+    elif change["exists"] and change["user_id"] and change["state"] == "assigned":
+        event = "taken"
+    else:
+        event = "removed"
+    return {
+        "id": str(change["event_id"]),
+        "event": event,
+        "data": {
+            "order_id": change["sale_id"],
+            "picking_id": change["id"],
+            "state": change["state"],
+        },
+    }
+
+
+class Broadcaster:
+    """Fans the events out to the queues of the subscribers. Event loop only."""
+
+    def __init__(self):
+        self.last_id = self._reset_id()
+        self.history = deque(maxlen=HISTORY_SIZE)
+        self.subscribers: Set[asyncio.Queue] = set()
+
+    @staticmethod
+    def _reset_id() -> str:
+        # Only known to this process: other ones answer it with a reset
+        return f"reset-{uuid.uuid4().hex[:8]}"
+
+    def reset(self):
+        """Changes may have been missed: forget the previous events"""
+        self.history.clear()
+        self.publish({"event": "reset", "data": {}, "id": self._reset_id()})
+
+    def publish(self, event: dict):
+        self.last_id = event["id"]
+        self.history.append(event)
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Too slow: end its stream, it will reconnect and catch up
+                self.subscribers.discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    def subscribe(self, last_event_id: Optional[str] = None) -> asyncio.Queue:
+        """Queue of the next events, after the missed ones when possible"""
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        if last_event_id:
+            for event in self.missed(last_event_id):
+                queue.put_nowait(event)
+        self.subscribers.add(queue)
+        return queue
+
+    def missed(self, last_event_id: str) -> List[dict]:
+        if last_event_id == self.last_id:
+            return []
+        ids = [event["id"] for event in self.history]
+        if last_event_id in ids:
+            missed = list(self.history)[ids.index(last_event_id) + 1 :]
+            if len(missed) < QUEUE_SIZE:
+                return missed
+        # Events were lost: the client must fetch the orders again
+        return [{"event": "reset", "data": {}, "id": self.last_id}]
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+    def close(self):
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
+        self.subscribers.clear()
+
+
+broadcaster = Broadcaster()
+
+
+class Listener(threading.Thread):
+    """Listens to the picking changes on its own database connection"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, db_name: str):
+        super().__init__(name="order-events", daemon=True)
+        self.loop = loop
+        self.db_name = db_name
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.listen()
+            except psycopg2.Error:
+                logger.exception("[!] Order events listener failed, reconnecting")
+                self.stopping.wait(5)
+
+    def connect(self):
+        __, info = odoo.sql_db.connection_info_for(self.db_name)
+        connection = psycopg2.connect(**info)
+        connection.autocommit = True
+        return connection
+
+    def listen(self):
+        connection = self.connect()
+        try:
+            with connection.cursor() as cr:
+                if not trigger_exists(cr):
+                    logger.warning(
+                        "[!] No %s_notify trigger on stock_picking, order events "
+                        "will not be sent: run sql/order_events.sql",
+                        CHANNEL,
+                    )
+                cr.execute(f"LISTEN {CHANNEL}")
+            # Changes made while disconnected are lost
+            self.loop.call_soon_threadsafe(broadcaster.reset)
+            while not self.stopping.is_set():
+                if select.select([connection], [], [], 1.0) == ([], [], []):
+                    continue
+                connection.poll()
+                events = []
+                while connection.notifies:
+                    change = json.loads(connection.notifies.pop(0).payload)
+                    event = order_event(change)
+                    if event:
+                        events.append(event)
+                for event in events:
+                    self.loop.call_soon_threadsafe(broadcaster.publish, event)
+        finally:
+            connection.close()
+
+
+def trigger_exists(cr) -> bool:
+    """Whether the trigger of `sql/order_events.sql` notifies the changes"""
+    cr.execute(
+        "SELECT 1 FROM pg_trigger WHERE tgname = %s "
+        "AND tgrelid = 'stock_picking'::regclass",
+        [f"{CHANNEL}_notify"],
+    )
+    return cr.fetchone() is not None
+
+
+_listener: Optional[Listener] = None
+
+
+def start(loop: asyncio.AbstractEventLoop):
+    global _listener
+    _listener = Listener(loop, odoo.tools.config["db_name"])
+    _listener.start()
+
+
+def stop():
+    if _listener is not None:
+        _listener.stopping.set()
+        _listener.join(timeout=5)
+    broadcaster.close()
+
+
+def format_event(event: dict) -> str:
+    lines = [f"event: {event['event']}"]
+    if "id" in event:
+        lines.append(f"id: {event['id']}")
+    lines.append(f"data: {json.dumps(event['data'])}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def stream(last_event_id: Optional[str] = None):
+    """Server-sent events of a subscriber, with heartbeats, until it disconnects"""
+    queue = broadcaster.subscribe(last_event_id)
+    loop = asyncio.get_running_loop()
+    ends_at = loop.time() + MAX_STREAM_SECONDS
+    try:
+        yield f"retry: {RECONNECT_MILLISECONDS}\n\n"
+        while loop.time() < ends_at:
+            try:
+                event = await asyncio.wait_for(queue.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            if event is None:
+                break
+            yield format_event(event)
+    finally:
+        broadcaster.unsubscribe(queue)
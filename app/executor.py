@@ -0,0 +1,155 @@
+"""Threads and database cursors running the blocking Odoo ORM work.
+
+Route handlers and dependencies doing ORM calls are plain `def` functions,
+which FastAPI runs on the anyio worker threads instead of the event loop.
+
+A request keeps its cursor from its Odoo environment dependency until the
+response is sent, giving the thread back in between, so bounding the
+threads does not bound the cursors. Requests therefore wait for one of
+ORM_MAX_WORKERS cursor slots, in the event loop, before opening their
+cursor. The other cursors (authentication checks, logins, background jobs)
+share the rest of Odoo `db_maxconn`, and block their thread until one is
+free.
+"""
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import anyio.to_thread
+import odoo
+
+from .settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+
+class WaitStats:
+    """Time requests waited for a cursor"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+
+wait_stats = WaitStats()
+
+
+class CursorLimiter:
+    """Cursor slots of the requests. Event loop only."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.busy = 0
+        self.queued = 0
+        self._semaphore = asyncio.Semaphore(total)
+
+    async def acquire(self):
+        started = time.monotonic()
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.busy += 1
+        wait_stats.record(time.monotonic() - started)
+
+    def release(self):
+        self.busy -= 1
+        self._semaphore.release()
+
+
+_request_cursors: Optional[CursorLimiter] = None
+_other_cursors: Optional[threading.BoundedSemaphore] = None
+
+
+async def request_cursor_slot():
+    """Dependency holding a cursor slot for the rest of the request.
+
+    Waiting in the event loop holds no worker thread, which the requests
+    already holding a cursor need to finish.
+    """
+    if _request_cursors is None:
+        yield
+        return
+    await _request_cursors.acquire()
+    try:
+        yield
+    finally:
+        _request_cursors.release()
+
+
+@contextlib.contextmanager
+def cursor_slot():
+    """Hold one of the cursor slots left to the work outside of the requests"""
+    if _other_cursors is None:
+        yield
+        return
+    with _other_cursors:
+        yield
+
+
+def orm_max_workers() -> int:
+    db_maxconn = odoo.tools.config["db_maxconn"]
+    if "ORM_MAX_WORKERS" in SETTINGS:
+        workers = int(SETTINGS["ORM_MAX_WORKERS"])
+    else:
+        # Leave room in the pool for the authentication and background cursors
+        workers = max(1, db_maxconn // 2)
+    if workers >= db_maxconn:
+        logger.warning(
+            "[!] ORM_MAX_WORKERS (%s) should be lower than Odoo db_maxconn (%s)",
+            workers,
+            db_maxconn,
+        )
+    return workers
+
+
+def configure_executor():
+    """Size the worker threads and cursor slots.
+
+    Must run in the event loop, after Odoo config is parsed.
+    """
+    global _request_cursors, _other_cursors
+    workers = orm_max_workers()
+    anyio.to_thread.current_default_thread_limiter().total_tokens = workers
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=workers, thread_name_prefix="orm")
+    )
+    others = max(1, odoo.tools.config["db_maxconn"] - workers)
+    _request_cursors = CursorLimiter(workers)
+    _other_cursors = threading.BoundedSemaphore(others)
+    logger.info(
+        "[.] %s ORM worker threads and request cursors, %s other cursors",
+        workers,
+        others,
+    )
+
+
+def statistics() -> dict:
+    limiter = anyio.to_thread.current_default_thread_limiter().statistics()
+    cursors = _request_cursors
+    return dict(
+        threads=limiter.total_tokens,
+        busy=limiter.borrowed_tokens,
+        queued=limiter.tasks_waiting,
+        cursors=cursors.total if cursors else 0,
+        busy_cursors=cursors.busy if cursors else 0,
+        queued_for_cursor=cursors.queued if cursors else 0,
+        waits=wait_stats.count,
+        avg_wait_ms=wait_stats.total / wait_stats.count * 1000
+        if wait_stats.count
+        else 0.0,
+        max_wait_ms=wait_stats.max * 1000,
+    )
@@ -0,0 +1,216 @@
+"""Spatial index of the unassigned orders.
+
+Delivery coordinates of the unassigned orders are kept in memory, bucketed
+in a grid of `CELL_DEGREES` cells. A radius query only computes the
+haversine distance, with NumPy, of the orders of the cells around it.
+
+The index is loaded in the background, then kept up to date from the order
+events (see `app.events`), and rebuilt every `REFRESH_SECONDS` in case some
+change was missed.
+"""
+import asyncio
+import logging
+import math
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from . import events
+from .dependencies import get_odoo_env
+from .settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+CELL_DEGREES = float(SETTINGS.get("NEARBY_CELL_DEGREES", "0.1"))
+REFRESH_SECONDS = float(SETTINGS.get("NEARBY_REFRESH_SECONDS", "300"))
+
+Coordinates = Tuple[float, float]
+# Delivery coordinates of the unassigned orders among `order_ids`, all when None
+Loader = Callable[..., Dict[int, Coordinates]]
+
+
+def haversine_km(
+    lat: float, lon: float, lats: np.ndarray, lons: np.ndarray
+) -> np.ndarray:
+    """Great-circle distances from (lat, lon) to each of (lats, lons)"""
+    lat, lon = math.radians(lat), math.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = (
+        np.sin((lats - lat) / 2) ** 2
+        + math.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _cell(lat: float, lon: float) -> Tuple[int, int]:
+    return int(math.floor(lat / CELL_DEGREES)), int(math.floor(lon / CELL_DEGREES))
+
+
+class GridIndex:
+    """Thread-safe points bucketed by grid cell"""
+
+    def __init__(self, points: Optional[Dict[int, Coordinates]] = None):
+        self._lock = threading.Lock()
+        self._points: Dict[int, Coordinates] = {}
+        self._cells: Dict[Tuple[int, int], Set[int]] = {}
+        for key, coordinates in (points or {}).items():
+            self._add(key, coordinates)
+
+    def __len__(self):
+        return len(self._points)
+
+    def _add(self, key: int, coordinates: Coordinates):
+        self._remove(key)
+        self._points[key] = coordinates
+        self._cells.setdefault(_cell(*coordinates), set()).add(key)
+
+    def _remove(self, key: int):
+        coordinates = self._points.pop(key, None)
+        if coordinates is None:
+            return
+        cell = _cell(*coordinates)
+        self._cells[cell].discard(key)
+        if not self._cells[cell]:
+            del self._cells[cell]
+
+    def update(self, points: Dict[int, Coordinates], removed: Iterable[int] = ()):
+        with self._lock:
+            for key in removed:
+                self._remove(key)
+            for key, coordinates in points.items():
+                self._add(key, coordinates)
+
+    def remove(self, key: int):
+        with self._lock:
+            self._remove(key)
+
+    def replace(self, points: Dict[int, Coordinates]):
+        index = GridIndex(points)
+        with self._lock:
+            self._points, self._cells = index._points, index._cells
+
+    def _candidates(self, lat: float, lon: float, radius_km: float) -> List[int]:
+        lat_span = math.degrees(radius_km / EARTH_RADIUS_KM)
+        cos_lat = math.cos(math.radians(min(abs(lat) + lat_span, 90.0)))
+        if cos_lat < 1e-6:
+            # Close to a pole: every longitude is within the radius
+            lon_span = 180.0
+        else:
+            lon_span = min(lat_span / cos_lat, 180.0)
+        (min_i, min_j), (max_i, max_j) = (
+            _cell(lat - lat_span, lon - lon_span),
+            _cell(lat + lat_span, lon + lon_span),
+        )
+        if (max_i - min_i + 1) * (max_j - min_j + 1) > len(self._cells):
+            # Wider than the occupied cells: scan those instead
+            return list(self._points)
+        turn = round(360 / CELL_DEGREES)
+        keys = set()
+        for i in range(min_i, max_i + 1):
+            for j in range(min_j, min(max_j, min_j + turn - 1) + 1):
+                # Longitudes wrap around the antimeridian
+                wrapped = (j + turn // 2) % turn - turn // 2
+                keys.update(self._cells.get((i, wrapped), ()))
+        return list(keys)
+
+    def nearby(
+        self, lat: float, lon: float, radius_km: float, limit: int
+    ) -> List[Tuple[int, float, Coordinates]]:
+        """(key, distance in km, coordinates) of the nearest points within the radius"""
+        with self._lock:
+            keys = self._candidates(lat, lon, radius_km)
+            coordinates = np.array(
+                [self._points[key] for key in keys], dtype=float
+            ).reshape(-1, 2)
+        distances = haversine_km(lat, lon, coordinates[:, 0], coordinates[:, 1])
+        within = np.flatnonzero(distances <= radius_km)
+        if len(within) > limit:
+            within = within[np.argpartition(distances[within], limit - 1)[:limit]]
+        within = within[np.argsort(distances[within], kind="stable")]
+        return [
+            (keys[i], float(distances[i]), (float(lat), float(lon)))
+            for i in within
+            for lat, lon in [coordinates[i]]
+        ]
+
+
+class NearbyOrders:
+    """Index of the unassigned orders, and the thread keeping it up to date"""
+
+    def __init__(self):
+        self.index = GridIndex()
+        self.ready = False
+        self.loaded_at = 0.0
+        # Order ids to load, None for all of them
+        self._pending: "queue.Queue[Optional[int]]" = queue.Queue()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, loader: Loader):
+        self._thread = threading.Thread(
+            target=self._refresh, args=(loader,), name="nearby-orders", daemon=True
+        )
+        self._thread.start()
+        self._task = asyncio.get_running_loop().create_task(self._follow_events())
+
+    def stop(self):
+        self._stopping.set()
+        self._pending.put(None)
+        if self._task is not None:
+            self._task.cancel()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    async def _follow_events(self):
+        while True:
+            subscription = events.broadcaster.subscribe()
+            try:
+                while True:
+                    event = await subscription.get()
+                    if event is None:
+                        # Dropped by the broadcaster: changes may be missed
+                        self._pending.put(None)
+                        break
+                    if event["event"] == "added":
+                        self._pending.put(event["data"]["order_id"])
+                    elif event["event"] in ("taken", "removed"):
+                        self.index.remove(event["data"]["order_id"])
+                    elif event["event"] == "reset":
+                        self._pending.put(None)
+            finally:
+                events.broadcaster.unsubscribe(subscription)
+
+    def _refresh(self, loader: Loader):
+        self._pending.put(None)
+        while not self._stopping.is_set():
+            timeout = max(0.0, self.loaded_at + REFRESH_SECONDS - time.monotonic())
+            try:
+                order_ids = {self._pending.get(timeout=timeout)}
+            except queue.Empty:
+                order_ids = {None}
+            # Load the orders added meanwhile at once
+            while not self._pending.empty():
+                order_ids.add(self._pending.get_nowait())
+            if self._stopping.is_set():
+                break
+            try:
+                with get_odoo_env() as env:
+                    if None in order_ids:
+                        self.index.replace(loader(env))
+                        self.loaded_at = time.monotonic()
+                        self.ready = True
+                    else:
+                        points = loader(env, list(order_ids))
+                        self.index.update(points, removed=order_ids - set(points))
+            except Exception:
+                logger.exception("[!] Loading the nearby orders failed")
+                self._stopping.wait(5)
+                self._pending.put(None)
+
+
+nearby_orders = NearbyOrders()
@@ -0,0 +1,133 @@
+"""Idempotency keys of the order mutations.
+
+A client retrying a request with the same `Idempotency-Key` header gets the
+response of the first request back, without it being processed again.
+
+Keys are stored in the database, in the transaction of the request, so that
+every API process sees them, and only once the changes of the request are
+committed. A retry arriving while the first request is running waits for it
+on the unique index of the keys. Reusing a key for another request body is
+an error.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+from fastapi import Header, HTTPException, Request, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from .settings import SETTINGS
+
+TABLE = "nextway_api_idempotency_key"
+TTL = timedelta(seconds=int(SETTINGS.get("IDEMPOTENCY_TTL_SECONDS", "3600")))
+
+
+class IdempotentReplay(Exception):
+    def __init__(self, status_code: int, content: Any):
+        self.status_code = status_code
+        self.content = content
+
+
+async def replay_response(request: Request, exc: IdempotentReplay):
+    return JSONResponse(
+        exc.content,
+        status_code=exc.status_code,
+        headers={"Idempotent-Replayed": "true"},
+    )
+
+
+class Idempotency:
+    def __init__(self, key: Optional[str], scope: str, fingerprint: Optional[str]):
+        self.key = key
+        self.scope = scope
+        self.fingerprint = fingerprint
+        self.cr = None
+        self.username = None
+        self.response = None
+
+    def start(self, env, username: str):
+        """Replay the stored response of the key, if any. Call before doing anything.
+
+        Call again when the transaction is retried: the key is inserted in
+        the transaction of `env`, and stored or removed when it commits.
+        """
+        if not self.key:
+            return
+        cr = env.cr
+        key = (username, self.scope, self.key)
+        # Expired keys of the user can be used again
+        cr.execute(
+            f"DELETE FROM {TABLE} WHERE username = %s AND created_at < %s",
+            (username, datetime.utcnow() - TTL),
+        )
+        # Waits for a concurrent request with the same key to end. Fails with
+        # a serialization error, retried, when it committed in the meantime.
+        cr.execute(
+            f"""
+            INSERT INTO {TABLE} (username, scope, key, fingerprint)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (username, scope, key) DO NOTHING
+            RETURNING id
+            """,
+            (*key, self.fingerprint),
+        )
+        if cr.fetchone() is None:
+            cr.execute(
+                f"SELECT fingerprint, status_code, response FROM {TABLE} "
+                "WHERE username = %s AND scope = %s AND key = %s",
+                key,
+            )
+            fingerprint, status_code, response = cr.fetchone()
+            if fingerprint != self.fingerprint:
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail="This Idempotency-Key was used for another request",
+                )
+            raise IdempotentReplay(status_code, response)
+        self.cr, self.username, self.response = cr, username, None
+        cr.precommit.add(self._save)
+
+    def remember(self, content: Any, status_code: int = status.HTTP_200_OK) -> Any:
+        """Store `content` as the response to replay, once the request succeeded"""
+        self.response = (status_code, jsonable_encoder(content))
+        return content
+
+    def _save(self):
+        key = (self.username, self.scope, self.key)
+        if self.response is None:
+            # Nothing to replay, e.g. an error returned in the body
+            self.cr.execute(
+                f"DELETE FROM {TABLE} "
+                "WHERE username = %s AND scope = %s AND key = %s",
+                key,
+            )
+            return
+        status_code, content = self.response
+        self.cr.execute(
+            f"UPDATE {TABLE} SET status_code = %s, response = %s "
+            "WHERE username = %s AND scope = %s AND key = %s",
+            (status_code, json.dumps(content), *key),
+        )
+
+
+async def idempotency(
+    request: Request,
+    idempotency_key: Optional[str] = Header(
+        default=None,
+        description="Unique key of the operation. Retries with the same key "
+        "get the response of the first request.",
+    ),
+) -> Idempotency:
+    """Idempotency of the request, see `Idempotency.start`"""
+    fingerprint = None
+    if idempotency_key:
+        # Already read and kept by FastAPI for the body parameters
+        body = await request.body()
+        fingerprint = hashlib.sha256(
+            request.url.query.encode() + b"\n" + body
+        ).hexdigest()
+    return Idempotency(
+        idempotency_key, f"{request.method} {request.url.path}", fingerprint
+    )
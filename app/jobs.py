@@ -0,0 +1,199 @@
+"""Background jobs of the API.
+
+Heavy ORM work a request does not need to wait for runs on its own pool of
+worker threads, sized by DROP_OFF_WORKERS, with a transaction of its own.
+
+Jobs are stored in the `nextway_api_job` table, inserted in the transaction
+of the request and run once it is committed, so that their status can be
+polled from any API process. A job runs a function registered by name with
+`register`, on the JSON arguments stored with it. The jobs left pending or
+running by a stopped or crashed process are run again at startup: the work
+of a job is committed together with its `done` status, and its row stays
+locked while it runs, so that it never runs twice.
+"""
+import json
+import logging
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from typing import Callable, Dict, Optional
+
+import odoo
+from pydantic import BaseModel
+
+from .dependencies import get_odoo_env
+from .retrying import run_in_transaction
+from .settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = int(SETTINGS.get("DROP_OFF_WORKERS", "2"))
+TTL = timedelta(seconds=int(SETTINGS.get("JOBS_TTL_SECONDS", "3600")))
+TABLE = "nextway_api_job"
+
+
+class JobStatus(str, Enum):
+    pending = "pending"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+class Job(BaseModel):
+    id: str
+    username: str
+    order_id: int
+    status: JobStatus = JobStatus.pending
+    error: Optional[str] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
+
+# Job name -> function(env, **arguments)
+functions: Dict[str, Callable[..., None]] = {}
+_pool: Optional[ThreadPoolExecutor] = None
+
+
+def register(name: str):
+    """Decorator registering a job function under `name`"""
+
+    def decorator(func):
+        functions[name] = func
+        return func
+
+    return decorator
+
+
+def start():
+    """Start the worker threads, then run the jobs left by the stopped processes.
+
+    Call once the server forked, from the process running the jobs.
+    """
+    global _pool
+    _pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="jobs")
+    with get_odoo_env() as env:
+        _delete_expired(env.cr)
+        # Those of the running processes are locked
+        env.cr.execute(
+            f"SELECT id FROM {TABLE} WHERE status IN %s "
+            "ORDER BY created_at FOR UPDATE SKIP LOCKED",
+            ((JobStatus.pending.value, JobStatus.running.value),),
+        )
+        job_ids = [job_id for job_id, in env.cr.fetchall()]
+    for job_id in job_ids:
+        _pool.submit(_run, job_id)
+    if job_ids:
+        logger.info("[.] Resumed %s background jobs", len(job_ids))
+
+
+def shutdown():
+    """Wait for the submitted jobs"""
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+
+
+def _delete_expired(cr):
+    """Delete the jobs finished for longer than TTL"""
+    # Rows another request is deleting are left to it, instead of waiting
+    cr.execute(
+        f"""
+        DELETE FROM {TABLE} WHERE id IN (
+            SELECT id FROM {TABLE} WHERE finished_at < %s FOR UPDATE SKIP LOCKED
+        )
+        """,
+        (datetime.utcnow() - TTL,),
+    )
+
+
+def _claim(env, job_id: str):
+    env.cr.execute(
+        f"UPDATE {TABLE} SET status = %s WHERE id = %s AND status = %s",
+        (JobStatus.running.value, job_id, JobStatus.pending.value),
+    )
+
+
+def _work(env, job_id: str) -> bool:
+    # Locked until committed with the `done` status, or rolled back
+    env.cr.execute(
+        f"SELECT name, arguments FROM {TABLE} "
+        "WHERE id = %s AND status = %s FOR UPDATE SKIP LOCKED",
+        (job_id, JobStatus.running.value),
+    )
+    row = env.cr.fetchone()
+    if row is None:
+        # Done, or running in another process
+        return False
+    name, arguments = row
+    functions[name](env, **arguments)
+    env.cr.execute(
+        f"UPDATE {TABLE} SET status = %s, finished_at = %s WHERE id = %s",
+        (JobStatus.done.value, datetime.utcnow(), job_id),
+    )
+    return True
+
+
+def _fail(job_id: str, error: str):
+    with get_odoo_env() as env:
+        env.cr.execute(
+            f"UPDATE {TABLE} SET status = %s, error = %s, finished_at = %s "
+            "WHERE id = %s AND status = %s",
+            (
+                JobStatus.failed.value,
+                error,
+                datetime.utcnow(),
+                job_id,
+                JobStatus.running.value,
+            ),
+        )
+
+
+def _run(job_id: str):
+    try:
+        with get_odoo_env() as env:
+            run_in_transaction(env, lambda: _claim(env, job_id), f"job {job_id}")
+        with get_odoo_env() as env:
+            run_in_transaction(env, lambda: _work(env, job_id), f"job {job_id}")
+    except (odoo.exceptions.UserError, odoo.exceptions.ValidationError) as e:
+        _fail(job_id, str(e))
+    except Exception:
+        logger.error("[!] Job %s failed\n%s", job_id, traceback.format_exc())
+        _fail(job_id, "Internal error")
+
+
+def submit_after_commit(
+    cr, username: str, order_id: int, name: str, **arguments
+) -> str:
+    """Run the job function `name` in the background once `cr` is committed.
+
+    The job is stored in the transaction of `cr`: nothing runs if it is
+    rolled back instead. Return the job id.
+    """
+    _delete_expired(cr)
+    job_id = uuid.uuid4().hex
+    cr.execute(
+        f"INSERT INTO {TABLE} (id, username, order_id, name, arguments) "
+        "VALUES (%s, %s, %s, %s, %s)",
+        (job_id, username, order_id, name, json.dumps(arguments)),
+    )
+    cr.postcommit.add(lambda: _pool.submit(_run, job_id))
+    return job_id
+
+
+def get_job(env, job_id: str, username: str) -> Optional[Job]:
+    env.cr.execute(
+        "SELECT id, username, order_id, status, error, created_at, finished_at "
+        f"FROM {TABLE} WHERE id = %s AND username = %s "
+        # Expired, even if not deleted yet
+        "AND (finished_at IS NULL OR finished_at >= %s)",
+        (job_id, username, datetime.utcnow() - TTL),
+    )
+    row = env.cr.dictfetchone()
+    if row is None:
+        return None
+    for name in ("created_at", "finished_at"):
+        if row[name]:
+            # Stored in UTC, like the Odoo dates
+            row[name] = row[name].replace(tzinfo=timezone.utc)
+    return Job(**row)
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from os import path
 
@@ -5,7 +6,9 @@ import odoo
 from fastapi import FastAPI
 from fastapi_pagination import add_pagination
 
-from .routers import authentication, orders, stats
+from . import events, executor, geo, idempotency, jobs, schema
+from .dependencies import configure_odoo, get_odoo_env
+from .routers import authentication, health, orders, stats
 
 # Follows https://fastapi.tiangolo.com/tutorial/bigger-applications/
 # Follows https://github.com/acsone/odooxp2021-fastapi/blob/master/odoo_fastapi_demo/app.py
@@ -20,19 +23,53 @@ app = FastAPI(
 
 
 @app.on_event("startup")
-def set_default_executor() -> None:
-    import asyncio
-    from concurrent.futures import ThreadPoolExecutor
+def initialize_odoo() -> None:
+    # Read Odoo config from $ODOO_RC.
+    odoo.tools.config.parse_config([])
+    configure_odoo()
+    # Load the registry now rather than on the first request. No-op when
+    # already preloaded by app.server.
+    odoo.registry(odoo.tools.config["db_name"])
+    with get_odoo_env() as env:
+        schema.install(env.cr)
 
-    loop = asyncio.get_running_loop()
-    # Tune this according to your requirements !
-    loop.set_default_executor(ThreadPoolExecutor(max_workers=5))
+
+@app.on_event("startup")
+async def set_default_executor() -> None:
+    # Threads and cursors sized from ORM_MAX_WORKERS and Odoo db_maxconn
+    executor.configure_executor()
 
 
 @app.on_event("startup")
-def initialize_odoo() -> None:
-    # Read Odoo config from $ODOO_RC.
-    odoo.tools.config.parse_config([])
+def start_jobs() -> None:
+    # Also resumes the jobs of the stopped processes
+    jobs.start()
+
+
+@app.on_event("startup")
+async def start_order_events() -> None:
+    events.start(asyncio.get_running_loop())
+
+
+@app.on_event("startup")
+async def start_nearby_orders() -> None:
+    # Kept up to date from the order events
+    geo.nearby_orders.start(orders.unassigned_order_coordinates)
+
+
+@app.on_event("shutdown")
+def stop_nearby_orders() -> None:
+    geo.nearby_orders.stop()
+
+
+@app.on_event("shutdown")
+def stop_order_events() -> None:
+    events.stop()
+
+
+@app.on_event("shutdown")
+def wait_for_jobs() -> None:
+    jobs.shutdown()
 
 
 app.include_router(authentication.router)
@@ -40,6 +77,9 @@ app.include_router(authentication.router)
 # app.include_router(partners.router)
 app.include_router(orders.router)
 app.include_router(stats.router)
+app.include_router(health.router)
+
+app.add_exception_handler(idempotency.IdempotentReplay, idempotency.replay_response)
 
 # Must be added last
 add_pagination(app)
@@ -0,0 +1,97 @@
+"""Retry of the transactions failing on concurrent updates.
+
+Like Odoo's own HTTP layer, a request whose transaction fails with a
+serialization failure or a deadlock is rolled back and run again, after a
+random backoff, instead of failing with a 500.
+"""
+import functools
+import logging
+import random
+import threading
+import time
+from collections import Counter
+
+import psycopg2
+from odoo.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY
+
+from .settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+MAX_TRIES = int(SETTINGS.get("DB_RETRY_MAX_TRIES", "5"))
+BACKOFF_SECONDS = float(SETTINGS.get("DB_RETRY_BACKOFF_SECONDS", "0.05"))
+
+
+class RetryStats:
+    """Transactions retried, and given up on, by PostgreSQL error code"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.retries = Counter()
+        self.failures = Counter()
+
+    def record(self, pgcode: str, retried: bool):
+        with self._lock:
+            (self.retries if retried else self.failures)[pgcode] += 1
+
+
+retry_stats = RetryStats()
+
+
+def backoff(tryno: int) -> float:
+    """Seconds to wait before the try `tryno` + 1: exponential, fully jittered"""
+    return random.uniform(0.0, BACKOFF_SECONDS * 2 ** (tryno - 1))
+
+
+def run_in_transaction(env, func, name: str):
+    """Call `func` and commit `env`, again while it fails on concurrency errors.
+
+    Changes of `func` must all go through `env`, since they are rolled back
+    before each retry.
+    """
+    for tryno in range(1, MAX_TRIES + 1):
+        try:
+            result = func()
+            env.cr.commit()
+            return result
+        except psycopg2.OperationalError as e:
+            if e.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY:
+                raise
+            env.cr.rollback()
+            env.reset()
+            env.registry.reset_changes()
+            retried = tryno < MAX_TRIES
+            retry_stats.record(e.pgcode, retried)
+            if not retried:
+                logger.warning("[!] %s failed after %s tries: %s", name, tryno, e)
+                raise
+            logger.info("[.] %s: %s, retry %s/%s", name, e.pgcode, tryno, MAX_TRIES - 1)
+            time.sleep(backoff(tryno))
+
+
+def retrying(handler):
+    """Run a route handler in its own transaction, retried on concurrency errors.
+
+    The handler must take the `principal` of the request, whose environment
+    is committed once it returns.
+    """
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        return run_in_transaction(
+            kwargs["principal"].env,
+            functools.partial(handler, *args, **kwargs),
+            handler.__name__,
+        )
+
+    return wrapper
+
+
+def statistics() -> dict:
+    with retry_stats._lock:
+        return dict(
+            retries=sum(retry_stats.retries.values()),
+            failures=sum(retry_stats.failures.values()),
+            retries_by_code=dict(retry_stats.retries),
+            failures_by_code=dict(retry_stats.failures),
+        )
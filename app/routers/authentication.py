@@ -1,24 +1,33 @@
+import asyncio
+import functools
 from datetime import timedelta
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Form, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
+from jose import JWTError, jwt
 
 from ..dependencies import (
+    ALGORITHM,
     API_KEY_NAME,
     API_KEY_SCOPE,
+    REFRESH_TOKEN_TYPE,
+    SECRET_KEY,
+    APIAccessTokenDoesNotExist,
     Token,
     User,
+    UserWithAccessTokenDoesNotExist,
     authenticate_user,
     create_access_token,
     get_current_active_user,
     get_odoo_env,
-    odoo_env,
+    invalidate_credentials,
+    verify_credentials,
 )
 from ..settings import SETTINGS
 
 router = APIRouter(
     tags=["auth"],
-    dependencies=[Depends(odoo_env)],
     responses={404: {"description": "Not found"}},
 )
 
@@ -43,15 +52,53 @@ def create_odoo_api_key_for_service_users(username):
                 ("user_id.id", "=", user.id),
             ]
         ).unlink()
+        # Again once committed: until then, a concurrent request still sees
+        # the old key and could verify and cache it again.
+        invalidate_credentials(username)
+        env.cr.postcommit.add(functools.partial(invalidate_credentials, username))
         r = env["res.users.apikeys"].with_user(user)._generate(scope=scope, name=name)
         # k = env['res.users.apikeys'].search([])
         return r
 
 
-@router.post("/token", response_model=Token)
-async def login_for_access_token(
-    form_data: OAuth2PasswordRequestForm = Depends(),
-):
+# Logins hash the password and generate an API key, both CPU bound: only let
+# a few run at once, so that a login rush can't starve the other requests.
+login_semaphore = asyncio.BoundedSemaphore(
+    int(SETTINGS.get("LOGIN_MAX_CONCURRENCY", "4"))
+)
+LOGIN_QUEUE_TIMEOUT = float(SETTINGS.get("LOGIN_QUEUE_TIMEOUT_SECONDS", "10"))
+
+
+def issue_tokens(username: str, api_key: str, scopes: list, refresh_token=None):
+    # default 4 hours
+    access_token_expires = timedelta(
+        minutes=int(SETTINGS.get("ACCESS_TOKEN_EXPIRE_MINUTES", str(60 * 4)))
+    )
+    access_token = create_access_token(
+        data={"sub": f"{username}|{api_key}", "scopes": scopes},
+        expires_delta=access_token_expires,
+    )
+    if refresh_token is None:
+        # default 7 days
+        refresh_token_expires = timedelta(
+            minutes=int(SETTINGS.get("REFRESH_TOKEN_EXPIRE_MINUTES", str(60 * 24 * 7)))
+        )
+        refresh_token = create_access_token(
+            data={
+                "sub": f"{username}|{api_key}",
+                "scopes": scopes,
+                "type": REFRESH_TOKEN_TYPE,
+            },
+            expires_delta=refresh_token_expires,
+        )
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+    }
+
+
+def login(form_data: OAuth2PasswordRequestForm):
     # Authenticate user with Odoo
     user = authenticate_user(form_data.username, form_data.password)
     if not user:
@@ -70,15 +117,58 @@ async def login_for_access_token(
             detail="Cannot authenticate user. Please contact administrator.",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    # default 4 hours
-    access_token_expires = timedelta(
-        minutes=int(SETTINGS.get("ACCESS_TOKEN_EXPIRE_MINUTES", str(60 * 4)))
+    return issue_tokens(user.username, __api_key__, form_data.scopes)
+
+
+@router.post("/token", response_model=Token)
+async def login_for_access_token(
+    form_data: OAuth2PasswordRequestForm = Depends(),
+):
+    """Log in with the password. Use `/token/refresh` to renew the access token."""
+    try:
+        await asyncio.wait_for(login_semaphore.acquire(), LOGIN_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many logins at once. Please retry.",
+            headers={"Retry-After": str(int(LOGIN_QUEUE_TIMEOUT))},
+        )
+    try:
+        return await run_in_threadpool(login, form_data)
+    finally:
+        login_semaphore.release()
+
+
+@router.post("/token/refresh", response_model=Token)
+def refresh_access_token(refresh_token: str = Form(...)):
+    """New access token for the API key of a refresh token.
+
+    Neither checks the password nor regenerates the API key: the refresh
+    token stops working once the user logs in again or the key is revoked.
+    """
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
     )
-    access_token = create_access_token(
-        data={"sub": f"{user.username}|{__api_key__}", "scopes": form_data.scopes},
-        expires_delta=access_token_expires,
+    try:
+        payload = jwt.decode(refresh_token, SECRET_KEY, algorithms=[ALGORITHM])
+        username, api_key = payload.get("sub", "").split("|", maxsplit=1)
+    except (JWTError, ValueError):
+        raise credentials_exception
+    if payload.get("type") != REFRESH_TOKEN_TYPE:
+        raise credentials_exception
+    try:
+        user = verify_credentials(username, api_key)
+    except (APIAccessTokenDoesNotExist, UserWithAccessTokenDoesNotExist):
+        raise credentials_exception
+    if user is None:
+        raise credentials_exception
+    if user.disabled:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    return issue_tokens(
+        username, api_key, payload.get("scopes", []), refresh_token=refresh_token
     )
-    return {"access_token": access_token, "token_type": "bearer"}
 
 
 # TODO: Comment/remove after test
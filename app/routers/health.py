@@ -0,0 +1,58 @@
+from typing import Dict
+
+import odoo
+from fastapi import APIRouter, Response, status
+from odoo.modules.registry import Registry
+from pydantic import BaseModel
+
+from .. import executor, retrying
+
+router = APIRouter(
+    prefix="/health",
+    tags=["health"],
+)
+
+
+class ExecutorStats(BaseModel):
+    threads: int
+    busy: int
+    queued: int
+    cursors: int
+    busy_cursors: int
+    queued_for_cursor: int
+    waits: int
+    avg_wait_ms: float
+    max_wait_ms: float
+
+
+@router.get("/executor", response_model=ExecutorStats)
+async def executor_stats():
+    """ORM worker threads and request cursors usage, and how long requests waited for a cursor"""
+    return ExecutorStats(**executor.statistics())
+
+
+class RetryStats(BaseModel):
+    retries: int
+    failures: int
+    retries_by_code: Dict[str, int]
+    failures_by_code: Dict[str, int]
+
+
+@router.get("/retries", response_model=RetryStats)
+async def retry_stats():
+    """Transactions retried after a concurrency error, and those given up on"""
+    return RetryStats(**retrying.statistics())
+
+
+class Readiness(BaseModel):
+    ready: bool
+
+
+@router.get("/ready", response_model=Readiness)
+async def ready(response: Response):
+    """Ready once the Odoo registry of the database is loaded"""
+    db_name = odoo.tools.config["db_name"]
+    is_ready = db_name in Registry.registries and Registry.registries[db_name].ready
+    if not is_ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return Readiness(ready=is_ready)
@@ -1,17 +1,42 @@
+import base64
+import hashlib
+import json
 import logging
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from enum import Enum
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Set
 
 import odoo
+import psycopg2.errors
 import pydantic
-from fastapi import APIRouter, Depends, HTTPException, Query, Security
-from fastapi_pagination import Page, paginate
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Response,
+    Security,
+    status,
+)
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi_pagination import Page, create_page, resolve_params
+from fastapi_pagination.cursor import CursorPage
 from odoo import _
+from odoo.osv import expression
 from pydantic import BaseModel, Field
 
-from .. import utils
-from ..dependencies import User, get_current_active_user, get_odoo_user, odoo_env
+from .. import events, geo, jobs, routing, utils
+from ..cache import TTLCache
+from ..dependencies import (
+    Principal,
+    User,
+    get_current_active_user,
+    get_current_principal,
+)
+from ..idempotency import Idempotency, idempotency
+from ..retrying import retrying
+from ..settings import SETTINGS
 
 router = APIRouter(
     prefix="/orders",
@@ -62,6 +87,129 @@ class PartnerDeliveryAddress(pydantic.BaseModel):
         orm_mode = True
         getter_dict = utils.GenericOdooGetter
 
+    @classmethod
+    def from_sale_orders(
+        cls, orders: odoo.models.Model, env: odoo.api.Environment
+    ) -> Dict[int, "PartnerDeliveryAddress"]:
+        """Delivery addresses of `orders`, keyed by order id.
+
+        Partners, and the states and countries of their addresses, are read
+        once for all the orders. Addresses are cached across requests, keyed
+        by the id and write date of the delivery and customer partners they
+        are built from.
+        """
+        orders = orders.filtered("partner_id")
+        Partner = env["res.partner"]
+        write_dates = {
+            partner_id: row["write_date"]
+            for partner_id, row in _read_by_id(
+                Partner,
+                [*orders.partner_shipping_id.ids, *orders.partner_id.ids],
+                ["write_date"],
+            ).items()
+        }
+        delivery_ids, to_resolve = {}, []
+        for shipping_id in dict.fromkeys(orders.partner_shipping_id.ids):
+            key = ("address_get", shipping_id, write_dates.get(shipping_id))
+            delivery_id = reference_cache.get(key)
+            if delivery_id is None:
+                to_resolve.append(shipping_id)
+            else:
+                delivery_ids[shipping_id] = delivery_id
+        if to_resolve:
+            shippings = Partner.browse(to_resolve)
+            # What `address_get` walks, read at once for the partners and their
+            # contacts, instead of once per partner
+            shippings.read(ADDRESS_GET_FIELDS, load=None)
+            shippings.child_ids.read(ADDRESS_GET_FIELDS, load=None)
+            for shipping in shippings:
+                delivery_id = shipping.address_get(["delivery"])["delivery"]
+                key = ("address_get", shipping.id, write_dates.get(shipping.id))
+                reference_cache.set(key, delivery_id)
+                delivery_ids[shipping.id] = delivery_id
+        delivery_address_ids = {
+            order.id: delivery_ids[order.partner_shipping_id.id]
+            for order in orders
+            if delivery_ids.get(order.partner_shipping_id.id)
+        }
+        # A delivery contact of the shipping partner
+        missing = set(delivery_address_ids.values()) - set(write_dates)
+        if missing:
+            write_dates.update(
+                (partner_id, row["write_date"])
+                for partner_id, row in _read_by_id(
+                    Partner, list(missing), ["write_date"]
+                ).items()
+            )
+
+        def cache_key(order):
+            partner_id = delivery_address_ids[order.id]
+            return (
+                "delivery_address",
+                env.lang,
+                partner_id,
+                write_dates[partner_id],
+                order.partner_id.id,
+                write_dates[order.partner_id.id],
+            )
+
+        result, to_build = {}, []
+        for order in orders:
+            if order.id not in delivery_address_ids:
+                continue
+            address = reference_cache.get(cache_key(order))
+            if address is None:
+                to_build.append(order)
+            else:
+                result[order.id] = address
+        if not to_build:
+            return result
+
+        partners = _read_by_id(
+            Partner,
+            [
+                *(delivery_address_ids[order.id] for order in to_build),
+                *(order.partner_id.id for order in to_build),
+            ],
+            [*PARTNER_READ_FIELDS, *DISPLAY_ADDRESS_FIELDS],
+        )
+        # Formatted from a single recordset, so that the states and countries
+        # `_display_address` reads are prefetched together
+        delivery_partners = Partner.browse(
+            list(dict.fromkeys(delivery_address_ids[order.id] for order in to_build))
+        )
+        delivery_partners.state_id.read(["code", "name"], load=None)
+        delivery_partners.country_id.read(["code", "name", "address_format"], load=None)
+        display_addresses = {
+            partner.id: partner._display_address() for partner in delivery_partners
+        }
+        states = _read_names(
+            env["res.country.state"],
+            [p["state_id"] for p in partners.values() if p["state_id"]],
+        )
+        countries = _read_names(
+            env["res.country"],
+            [p["country_id"] for p in partners.values() if p["country_id"]],
+        )
+        for order in to_build:
+            partner_id = delivery_address_ids[order.id]
+            values = utils.read_values(Partner, partners[partner_id])
+            state_id, country_id = values["state_id"], values["country_id"]
+            # Fall back on the customer coordinates
+            customer = partners[order.partner_id.id]
+            values.update(
+                display_address=display_addresses[partner_id],
+                state=states[state_id] if state_id else "",
+                country=countries[country_id] if country_id else "",
+                partner_latitude=values["partner_latitude"]
+                or customer["partner_latitude"],
+                partner_longitude=values["partner_longitude"]
+                or customer["partner_longitude"],
+            )
+            result[order.id] = cls(**values)
+            reference_cache.set(cache_key(order), result[order.id])
+        return result
+
 
 class Order(pydantic.BaseModel):
     id: int
@@ -100,69 +248,183 @@ class Order(pydantic.BaseModel):
     order_lines: List[OrderLine] = None
 
     @classmethod
-    def from_sale_order(
-        cls, p: odoo.models.Model, env: odoo.api.Environment
-    ) -> "Order":
-        delivery_address_id = (
-            p.partner_shipping_id.address_get(["delivery"])["delivery"]
-            if p.partner_id
-            else None
-        )
-        delivery_address = None
-        if delivery_address_id:
-            rec_delivery_address = env["res.partner"].browse(delivery_address_id)
-            delivery_address = PartnerDeliveryAddress.from_orm(rec_delivery_address)
-            delivery_address.display_address = rec_delivery_address._display_address()
-            delivery_address.state = rec_delivery_address.state_id.name or ""
-            delivery_address.country = rec_delivery_address.country_id.name or ""
-            delivery_address.partner_latitude = (
-                delivery_address.partner_latitude or p.partner_id.partner_latitude
+    def from_sale_orders(
+        cls,
+        orders: odoo.models.Model,
+        env: odoo.api.Environment,
+        fields: Optional[Set[str]] = None,
+    ) -> List["Order"]:
+        """Serialize a whole `sale.order` recordset.
+
+        Orders, pickings, lines, units of measure and delivery partners are
+        each read once for the whole recordset, so the number of queries stays
+        the same whatever the number of orders.
+
+        :param fields: Optional fields to set besides ORDER_CORE_FIELDS, all
+            when None. Relations that are not asked for are not read at all.
+        """
+        if not orders:
+            return []
+        wanted = ORDER_OPTIONAL_FIELDS if fields is None else fields
+        read_fields = ["display_name", "date_order", "picking_ids"]
+        read_fields += [name for name in ORDER_DIRECT_FIELDS if name in wanted]
+        if "order_lines" in wanted:
+            read_fields.append("order_line")
+        order_rows = orders.read(read_fields, load=None)
+        pickings = _read_by_id(
+            env["stock.picking"],
+            [pid for row in order_rows for pid in row["picking_ids"]],
+            PICKING_READ_FIELDS,
+        )
+        lines, uom_names = {}, {}
+        if "order_lines" in wanted:
+            lines = _read_by_id(
+                env["sale.order.line"],
+                [lid for row in order_rows for lid in row["order_line"]],
+                ORDER_LINE_READ_FIELDS,
             )
-            delivery_address.partner_longitude = (
-                delivery_address.partner_longitude or p.partner_id.partner_longitude
+            uom_names = _read_names(
+                env["uom.uom"],
+                [line["product_uom"] for line in lines.values() if line["product_uom"]],
+                "display_name",
             )
+        delivery_addresses = {}
+        if "delivery_address" in wanted:
+            delivery_addresses = PartnerDeliveryAddress.from_sale_orders(orders, env)
 
-        def get_order_line(ol):
-            sale_order_line = OrderLine.from_orm(ol)
-            sale_order_line.product_uom_name = ol.product_uom.display_name
-            return sale_order_line
-
-        order_lines = [get_order_line(ol) for ol in p.order_line]
-        return Order(
-            id=p.id,
-            display_name=p.display_name,
-            date_order=p.date_order,
-            scheduled_date=p.picking_ids.scheduled_date,
-            date_deadline=p.picking_ids.date_deadline,
-            expected_date=p.expected_date,
-            # commitment_date=p.commitment_date if p.commitment_date else None,
-            state=cls._state(p, p.picking_ids.state),
-            delivery_address=delivery_address,
-            require_signature=p.require_signature,
-            signed_by=cls._null_for_false(p, "signed_by"),
-            signed_on=p.signed_on,
-            validity_date=p.validity_date,
-            note=cls._null_for_false(p, "note"),
-            is_expired=p.is_expired,
-            amount_total=p.amount_total,
-            order_lines=order_lines,
-            # share_url=f"{p.get_base_url()}{p._get_share_url(redirect=True)}",
-        )
+        def get_order_line(line):
+            values = utils.read_values(env["sale.order.line"], line)
+            values["product_uom_name"] = uom_names.get(values.pop("product_uom"))
+            return OrderLine(**values)
+
+        result = []
+        for row in order_rows:
+            values = utils.read_values(orders, row)
+            # Orders are expected to have a single delivery
+            picking = pickings[row["picking_ids"][0]] if row["picking_ids"] else {}
+            order = dict(
+                id=values["id"],
+                display_name=values["display_name"],
+                date_order=values["date_order"],
+                scheduled_date=picking.get("scheduled_date") or None,
+                date_deadline=picking.get("date_deadline") or None,
+                # commitment_date=p.commitment_date if p.commitment_date else None,
+                state=cls._state(picking.get("state"), picking.get("user_id")),
+                **{
+                    name: values[name] for name in ORDER_DIRECT_FIELDS if name in values
+                },
+                # share_url=f"{p.get_base_url()}{p._get_share_url(redirect=True)}",
+            )
+            if "delivery_address" in wanted:
+                order["delivery_address"] = delivery_addresses.get(values["id"])
+            if "order_lines" in wanted:
+                order["order_lines"] = [
+                    get_order_line(lines[line_id]) for line_id in row["order_line"]
+                ]
+            # Unset fields are left out of the response
+            result.append(
+                Order(
+                    **{
+                        name: value
+                        for name, value in order.items()
+                        if name in ORDER_CORE_FIELDS or name in wanted
+                    }
+                )
+            )
+        return result
 
     @classmethod
-    def _state(cls, order, state):
-        if not state or (
-            state == PickingState.assigned and order.picking_ids.user_id.id is False
-        ):
+    def _state(cls, state, user_id):
+        if not state or (state == PickingState.assigned and not user_id):
             return "unassigned"
         return state
 
-    @classmethod
-    def _null_for_false(cls, order, key):
-        field = order._fields[key]
-        res = getattr(order, key, None)
-        if not res and field.type != "boolean":
-            return None
+
+# Always returned
+ORDER_CORE_FIELDS = {"id", "display_name", "date_order", "state"}
+ORDER_OPTIONAL_FIELDS = set(Order.__fields__) - ORDER_CORE_FIELDS
+# Order fields read as is from the sale order
+ORDER_DIRECT_FIELDS = [
+    "expected_date",
+    "require_signature",
+    "signed_by",
+    "signed_on",
+    "validity_date",
+    "note",
+    "is_expired",
+    "amount_total",
+]
+ORDER_FIELDS_DESCRIPTION = (
+    "Comma-separated order fields to return besides "
+    f"{', '.join(sorted(ORDER_CORE_FIELDS))}. All of them when omitted."
+)
+PICKING_READ_FIELDS = ["scheduled_date", "date_deadline", "state", "user_id"]
+ORDER_LINE_READ_FIELDS = [
+    "order_id",
+    "name",
+    "product_id",
+    "product_uom_qty",
+    "product_uom",
+    "discount",
+    "price_unit",
+    "price_tax",
+    "price_subtotal",
+    "qty_delivered",
+    "qty_invoiced",
+    "qty_to_invoice",
+    "invoice_status",
+]
+# Read by `res.partner.address_get`
+ADDRESS_GET_FIELDS = ["type", "is_company", "parent_id", "child_ids"]
+# Read by `res.partner._display_address`, besides PARTNER_READ_FIELDS
+DISPLAY_ADDRESS_FIELDS = ["commercial_company_name"]
+PARTNER_READ_FIELDS = [
+    "name",
+    "display_name",
+    "company_name",
+    "street",
+    "street2",
+    "zip",
+    "city",
+    "state_id",
+    "country_id",
+    "partner_latitude",
+    "partner_longitude",
+    "phone",
+    "mobile",
+]
+
+
+def _read_by_id(model: odoo.models.Model, ids: List[int], fields: List[str]) -> dict:
+    """Read `fields` of the records `ids` in a single query, keyed by id"""
+    records = model.browse(list(dict.fromkeys(ids)))
+    return {row["id"]: row for row in records.read(fields, load=None)}
+
+
+# Reference data rarely written, shared by the requests: delivery addresses,
+# and names of states, countries and units of measure. Cleared when Odoo
+# signals a cache invalidation.
+reference_cache = TTLCache(
+    maxsize=int(SETTINGS.get("REFERENCE_CACHE_MAX_SIZE", "4096")),
+    ttl=int(SETTINGS.get("REFERENCE_CACHE_TTL_SECONDS", "300")),
+)
+
+
+def _read_names(
+    model: odoo.models.Model, ids: List[int], field: str = "name"
+) -> Dict[int, str]:
+    """`field` of the records `ids`, keyed by id, read once per reference_cache TTL"""
+    names, missing = {}, []
+    for record_id in dict.fromkeys(ids):
+        name = reference_cache.get((model._name, field, model.env.lang, record_id))
+        if name is None:
+            missing.append(record_id)
+        else:
+            names[record_id] = name
+    for record_id, row in _read_by_id(model, missing, [field]).items():
+        names[record_id] = row[field]
+        reference_cache.set((model._name, field, model.env.lang, record_id), row[field])
+    return names
 
 
 STATE_DESCRIPTION = """\
@@ -195,8 +457,9 @@ class OrderNotFoundException(Exception):
     pass
 
 
-def get_order_obj(order_id: int, env: odoo.api.Environment, current_user: User):
-    __, odoo_user = get_odoo_user(current_user.username)
+def get_order_obj(
+    order_id: int, env: odoo.api.Environment, odoo_user: odoo.models.Model
+):
     order_obj = env["sale.order"].browse(order_id).with_user(odoo_user)
     error_header = None
     if not order_obj.exists():
@@ -209,53 +472,96 @@ def get_order_obj(order_id: int, env: odoo.api.Environment, current_user: User):
     return order_obj
 
 
+def accept_error(order_obj, odoo_user) -> Optional[str]:
+    """Why the driver can't accept the order, if so"""
+    error_header = None
+    if (
+        order_obj.picking_ids.user_id.id is not False
+        and order_obj.picking_ids.user_id.id != odoo.SUPERUSER_ID
+    ):
+        # Already assigned (and is not Odoo bot)
+        error_header = "Order can't be self-assigned"
+    if order_obj.picking_ids.user_id.id == odoo_user.id:
+        # Already assigned to driver
+        error_header = "Order already assigned to driver"
+    return error_header
+
+
+def lock_pickings(pickings):
+    """Lock the rows of `pickings` until the end of the transaction.
+
+    Pickings locked by another transaction, or changed by one since ours
+    started, are skipped instead of waited for. Return the locked pickings,
+    whose assignee is then read again from the database.
+    """
+    if not pickings:
+        return pickings
+    cr = pickings.env.cr
+    try:
+        with cr.savepoint(flush=False):
+            cr.execute(
+                "SELECT id FROM stock_picking WHERE id IN %s FOR UPDATE SKIP LOCKED",
+                [tuple(pickings.ids)],
+                log_exceptions=False,
+            )
+            ids = [row[0] for row in cr.fetchall()]
+    except psycopg2.errors.SerializationFailure:
+        # Some picking was written by a transaction committed since ours
+        # started: lock the others one by one
+        if len(pickings) == 1:
+            ids = []
+        else:
+            ids = [picking.id for picking in pickings if lock_pickings(picking)]
+    pickings.invalidate_recordset(["user_id"])
+    return pickings.browse(ids)
+
+
+def accept_message(current_user, odoo_user) -> str:
+    return _(
+        "Self-assign delivery responsible by %(user_name)s (#%(user_id)s) on %(timestamp)s",
+        user_name=current_user.username,
+        user_id=odoo_user.id,
+        timestamp=datetime.now().isoformat(),
+    )
+
+
 @router.post("/{order_id}/accept")
-async def accept(
+@retrying
+def accept(
     order_id: int,
-    env: odoo.api.Environment = Depends(odoo_env),
-    current_user: User = Security(get_current_active_user, scopes=["orders:post"]),
+    request_idempotency: Idempotency = Depends(idempotency),
+    principal: Principal = Security(get_current_principal, scopes=["orders:post"]),
 ):
     """Accept order job. Only for unassigned orders."""
-    __, odoo_user = get_odoo_user(current_user.username)
+    current_user, odoo_user, env = principal
+    request_idempotency.start(env, current_user.username)
     try:
-        order_obj = get_order_obj(order_id, env, current_user)
+        order_obj = get_order_obj(order_id, env, odoo_user)
     except OrderNotFoundException as e:
         return HTTPException(
             status_code=404, detail="Order not found", headers={"X-Error": str(e)}
         )
-    else:
-        # More validations
-        error_header = None
-        if (
-            order_obj.picking_ids.user_id.id is not False
-            and order_obj.picking_ids.user_id.id != odoo.SUPERUSER_ID
-        ):
-            # Already assigned (and is not Odoo bot)
-            error_header = "Order can't be self-assigned"
-        if order_obj.picking_ids.user_id.id == odoo_user.id:
-            # Already assigned to driver
-            error_header = "Order already assigned to driver"
-        if error_header:
-            return HTTPException(
-                status_code=404,
-                detail="Order not found",
-                headers={"X-Error": error_header},
-            )
+    # Another driver is accepting it right now: don't wait for them
+    picking = lock_pickings(order_obj.picking_ids)
+    if picking != order_obj.picking_ids:
+        raise HTTPException(status_code=409, detail="Order already taken")
+    # More validations, on the locked picking
+    error_header = accept_error(order_obj, odoo_user)
+    if error_header:
+        return HTTPException(
+            status_code=404,
+            detail="Order not found",
+            headers={"X-Error": error_header},
+        )
 
-    picking = order_obj.picking_ids
     # Log self-assignment on the picking
-    message = _(
-        "Self-assign delivery responsible by %(user_name)s (#%(user_id)s) on %(timestamp)s",
-        user_name=current_user.username,
-        user_id=odoo_user.id,
-        timestamp=datetime.now().isoformat(),
-    )
+    message = accept_message(current_user, odoo_user)
     picking._message_log(body=message)
     # Log self-assignment on the order
     order_obj._message_log(body=message)
     # Self-assign driver to picking
     picking.write({"user_id": odoo_user.id})
-    return {"object_id": order_obj.id}
+    return request_idempotency.remember({"object_id": order_obj.id})
 
 
 class DropOffRequestBody(BaseModel):
@@ -264,39 +570,32 @@ class DropOffRequestBody(BaseModel):
     message: Optional[str]
 
 
-@router.post("/{order_id}/drop-off")
-async def drop_off(
-    order_id: int,
-    request_body: DropOffRequestBody,
-    env: odoo.api.Environment = Depends(odoo_env),
-    current_user: User = Security(get_current_active_user, scopes=["orders:post"]),
-):
-    """Drop off job. Driver arrives at the delivery address, drop-off packages, collect payment,
-    and mark the order as complete."""
-    __, odoo_user = get_odoo_user(current_user.username)
-    try:
-        order_obj = get_order_obj(order_id, env, current_user)
-    except OrderNotFoundException as e:
-        return HTTPException(
-            status_code=404, detail="Order not found", headers={"X-Error": str(e)}
-        )
-    else:
-        # More validations
-        error_header = None
-        if order_obj.picking_ids.user_id.id != odoo_user.id:
-            # Restrict order is assigned to the requestor
-            error_header = "User not allowed to modify order"
-        if error_header:
-            return HTTPException(
-                status_code=404,
-                detail="Order not found",
-                headers={"X-Error": error_header},
-            )
+def assignee_error(order_obj, odoo_user) -> Optional[str]:
+    """Why the driver can't modify the order, if so"""
+    if order_obj.picking_ids.user_id.id != odoo_user.id:
+        # Restrict order is assigned to the requestor
+        return "User not allowed to modify order"
+
+
+def cancel_error(order_obj, odoo_user) -> Optional[str]:
+    """Why the driver can't cancel the order or its job, if so"""
+    error_header = assignee_error(order_obj, odoo_user)
+    if not error_header and (
+        order_obj.picking_ids.state not in CANCELLABLE_ORDER_PICKING_STATES
+    ):
+        # Restrict allowed order status that can be cancelled
+        error_header = "Order cannot be cancelled"
+    return error_header
 
+
+def drop_off_messages(
+    request_body: DropOffRequestBody, current_user, odoo_user
+) -> List[str]:
+    messages = []
     # Mark order drop off time when provided
     if request_body.drop_off_datetime:
-        order_obj._message_log(
-            body=_(
+        messages.append(
+            _(
                 "Drop off by %(user_name)s (#%(user_id)s) on %(timestamp)s",
                 user_name=current_user.username,
                 user_id=odoo_user.id,
@@ -305,8 +604,8 @@ async def drop_off(
         )
     # Mark collected payment time when provided
     if request_body.collection_datetime:
-        order_obj._message_log(
-            body=_(
+        messages.append(
+            _(
                 "Collection of payment by %(user_name)s (#%(user_id)s) on %(timestamp)s",
                 user_name=current_user.username,
                 user_id=odoo_user.id,
@@ -314,18 +613,94 @@ async def drop_off(
             )
         )
     if request_body.message:
-        order_obj._message_log(
-            body=_(
+        messages.append(
+            _(
                 "Drop off message by %(user_name)s (#%(user_id)s) <br/><br/> %(message)s",
                 user_name=current_user.username,
                 user_id=odoo_user.id,
                 message=request_body.message,
             )
         )
+    return messages
+
+
+@router.post("/{order_id}/drop-off")
+@retrying
+def drop_off(
+    order_id: int,
+    request_body: DropOffRequestBody,
+    request_idempotency: Idempotency = Depends(idempotency),
+    principal: Principal = Security(get_current_principal, scopes=["orders:post"]),
+    prefer: Optional[str] = Header(
+        default=None,
+        description="`respond-async` to validate the picking in the background: "
+        "answers 202 with the id of the job, see `GET /orders/jobs/{job_id}`.",
+    ),
+):
+    """Drop off job. Driver arrives at the delivery address, drop-off packages, collect payment,
+    and mark the order as complete."""
+    current_user, odoo_user, env = principal
+    request_idempotency.start(env, current_user.username)
+    try:
+        order_obj = get_order_obj(order_id, env, odoo_user)
+    except OrderNotFoundException as e:
+        return HTTPException(
+            status_code=404, detail="Order not found", headers={"X-Error": str(e)}
+        )
+    else:
+        # More validations
+        error_header = assignee_error(order_obj, odoo_user)
+        if error_header:
+            return HTTPException(
+                status_code=404,
+                detail="Order not found",
+                headers={"X-Error": error_header},
+            )
+
+    for message in drop_off_messages(request_body, current_user, odoo_user):
+        order_obj._message_log(body=message)
     # Picking
     picking = order_obj.picking_ids
+    if prefer and "respond-async" in prefer.lower():
+        # Chatter messages are committed with the request, the validation
+        # runs afterwards in its own transaction
+        job_id = jobs.submit_after_commit(
+            env.cr,
+            current_user.username,
+            order_obj.id,
+            "validate_pickings",
+            uid=odoo_user.id,
+            picking_ids=picking.ids,
+        )
+        content = {"object_id": order_obj.id, "job_id": job_id}
+        return JSONResponse(
+            request_idempotency.remember(content, status.HTTP_202_ACCEPTED),
+            status_code=status.HTTP_202_ACCEPTED,
+            headers={
+                "Location": router.url_path_for("get_job", job_id=job_id),
+                "Preference-Applied": "respond-async",
+            },
+        )
     picking.button_validate()
-    return {"object_id": order_obj.id}
+    return request_idempotency.remember({"object_id": order_obj.id})
+
+
+@jobs.register("validate_pickings")
+def validate_pickings(env: odoo.api.Environment, uid: int, picking_ids: List[int]):
+    """Job validating the pickings of an asynchronous drop-off, as the driver"""
+    env["stock.picking"].with_user(uid).browse(picking_ids).button_validate()
+
+
+@router.get("/jobs/{job_id}", response_model=jobs.Job)
+def get_job(
+    job_id: str,
+    principal: Principal = Security(get_current_principal, scopes=["orders:post"]),
+):
+    """Status of a background job, such as an asynchronous drop-off"""
+    job = jobs.get_job(principal.env, job_id, principal.user.username)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 
 class CancelBody(BaseModel):
@@ -333,29 +708,25 @@ class CancelBody(BaseModel):
 
 
 @router.post("/{order_id}/cancel-order")
-async def cancel_order(
+@retrying
+def cancel_order(
     order_id: int,
     request_body: CancelBody,
-    env: odoo.api.Environment = Depends(odoo_env),
-    current_user: User = Security(get_current_active_user, scopes=["orders:post"]),
+    request_idempotency: Idempotency = Depends(idempotency),
+    principal: Principal = Security(get_current_principal, scopes=["orders:post"]),
 ):
     """Cancel order itself. Only possible for orders assigned to the requestor."""
-    __, odoo_user = get_odoo_user(current_user.username)
+    current_user, odoo_user, env = principal
+    request_idempotency.start(env, current_user.username)
     try:
-        order_obj = get_order_obj(order_id, env, current_user)
+        order_obj = get_order_obj(order_id, env, odoo_user)
     except OrderNotFoundException as e:
         return HTTPException(
             status_code=404, detail="Order not found", headers={"X-Error": str(e)}
         )
     else:
         # More validations
-        error_header = None
-        if order_obj.picking_ids.user_id.id != odoo_user.id:
-            # Restrict order is assigned to the requestor
-            error_header = "User not allowed to modify order"
-        elif order_obj.picking_ids.state not in CANCELLABLE_ORDER_PICKING_STATES:
-            # Restrict allowed order status that can be cancelled
-            error_header = "Order cannot be cancelled"
+        error_header = cancel_error(order_obj, odoo_user)
         if error_header:
             return HTTPException(
                 status_code=404,
@@ -376,33 +747,42 @@ async def cancel_order(
             message=message,
         )
     )
-    return {"object_id": order_obj.id}
+    return request_idempotency.remember({"object_id": order_obj.id})
+
+
+def cancel_job_message(
+    picking, request_body: CancelBody, current_user, odoo_user
+) -> str:
+    message = _(
+        "Remove assignment of %(user_name)s (#%(user_id)s) for delivery (#%(picking_id)s) on %(timestamp)s",
+        user_name=current_user.username,
+        user_id=odoo_user.id,
+        picking_id=picking.id,
+        timestamp=datetime.now().isoformat(),
+    )
+    return message + "<br/>" + request_body.message
 
 
 @router.post("/{order_id}/cancel-job")
-async def cancel_order_job(
+@retrying
+def cancel_order_job(
     order_id: int,
     request_body: CancelBody,
-    env: odoo.api.Environment = Depends(odoo_env),
-    current_user: User = Security(get_current_active_user, scopes=["orders:post"]),
+    request_idempotency: Idempotency = Depends(idempotency),
+    principal: Principal = Security(get_current_principal, scopes=["orders:post"]),
 ):
     """Unassign the job. Only possible for orders assigned to the requestor."""
-    __, odoo_user = get_odoo_user(current_user.username)
+    current_user, odoo_user, env = principal
+    request_idempotency.start(env, current_user.username)
     try:
-        order_obj = get_order_obj(order_id, env, current_user)
+        order_obj = get_order_obj(order_id, env, odoo_user)
     except OrderNotFoundException as e:
         return HTTPException(
             status_code=404, detail="Order not found", headers={"X-Error": str(e)}
         )
     else:
         # More validations
-        error_header = None
-        if order_obj.picking_ids.user_id.id != odoo_user.id:
-            # Restrict order is assigned to the requestor
-            error_header = "User not allowed to modify order"
-        elif order_obj.picking_ids.state not in CANCELLABLE_ORDER_PICKING_STATES:
-            # Restrict allowed order status that can be cancelled
-            error_header = "Order cannot be cancelled"
+        error_header = cancel_error(order_obj, odoo_user)
         if error_header:
             return HTTPException(
                 status_code=404,
@@ -413,57 +793,732 @@ async def cancel_order_job(
     # Do order unassignment
     picking = order_obj.picking_ids
     # Log self-unassignment on the picking
-    message = _(
-        "Remove assignment of %(user_name)s (#%(user_id)s) for delivery (#%(picking_id)s) on %(timestamp)s",
-        user_name=current_user.username,
-        user_id=odoo_user.id,
-        picking_id=picking.id,
-        timestamp=datetime.now().isoformat(),
-    )
-    message += "<br/>" + request_body.message
+    message = cancel_job_message(picking, request_body, current_user, odoo_user)
     picking._message_log(body=message)
     # Log self-unassignment on the order
     order_obj._message_log(body=message)
     # Remove driver assignment to picking
     picking.write({"user_id": False})
-    return {"object_id": order_obj.id}
+    return request_idempotency.remember({"object_id": order_obj.id})
+
 
+class BatchAction(str, Enum):
+    accept = "accept"
+    drop_off = "drop-off"
+    cancel_job = "cancel-job"
 
-@router.get("/", response_model=Page[Order])
-async def list_orders(
+
+class BatchItem(BaseModel):
+    order_id: int
+    action: BatchAction
+    # Request body of the single order endpoint of the action
+    payload: Dict[str, Any] = {}
+
+
+class BatchItemResult(BaseModel):
+    order_id: int
+    action: BatchAction
+    status_code: int
+    object_id: Optional[int] = None
+    error: Optional[str] = None
+
+
+@router.post("/batch", response_model=List[BatchItemResult])
+@retrying
+def batch(
+    items: List[BatchItem],
+    request_idempotency: Idempotency = Depends(idempotency),
+    principal: Principal = Security(get_current_principal, scopes=["orders:post"]),
+):
+    """Accept, drop off or cancel the job of many orders at once.
+
+    Items are validated like their single order endpoint, then applied
+    together in one transaction. Each item gets its own result; an item that
+    fails does not prevent the others.
+    """
+    current_user, odoo_user, env = principal
+    request_idempotency.start(env, current_user.username)
+    # Fetch the orders and their pickings once for all items
+    orders = (
+        env["sale.order"]
+        .with_user(odoo_user)
+        .browse([item.order_id for item in items])
+        .exists()
+    )
+    orders.picking_ids.mapped("user_id")
+    # Lock the pickings to accept before validating them, see `accept`. Only
+    # those of existing orders: the missing ones get a 404 below.
+    accept_ids = {item.order_id for item in items if item.action == BatchAction.accept}
+    locked = lock_pickings(orders.filtered(lambda o: o.id in accept_ids).picking_ids)
+    results = [
+        BatchItemResult(order_id=item.order_id, action=item.action, status_code=200)
+        for item in items
+    ]
+    accepts, unassigns, drop_offs = {}, {}, []
+    seen = set()
+    for item, result in zip(items, results):
+        order_obj = orders.browse(item.order_id)
+        try:
+            if item.order_id in seen:
+                raise OrderNotFoundException("Order is already in the batch")
+            seen.add(item.order_id)
+            if order_obj not in orders:
+                raise OrderNotFoundException("Order does not exist")
+            if len(order_obj.picking_ids) == 0:
+                raise OrderNotFoundException("Order must have picking")
+            if item.action == BatchAction.accept:
+                if not order_obj.picking_ids <= locked:
+                    result.status_code, result.error = 409, "Order already taken"
+                    continue
+                error_header = accept_error(order_obj, odoo_user)
+            elif item.action == BatchAction.drop_off:
+                error_header = assignee_error(order_obj, odoo_user)
+                request_body = DropOffRequestBody(**item.payload)
+            else:
+                error_header = cancel_error(order_obj, odoo_user)
+                request_body = CancelBody(**item.payload)
+        except OrderNotFoundException as e:
+            result.status_code, result.error = 404, str(e)
+            continue
+        except pydantic.ValidationError as e:
+            result.status_code, result.error = 422, str(e)
+            continue
+        if error_header:
+            result.status_code, result.error = 404, error_header
+            continue
+        result.object_id = order_obj.id
+        if item.action == BatchAction.accept:
+            accepts[order_obj.id] = accept_message(current_user, odoo_user)
+        elif item.action == BatchAction.drop_off:
+            drop_offs.append((order_obj, request_body, result))
+        else:
+            unassigns[order_obj.id] = cancel_job_message(
+                order_obj.picking_ids, request_body, current_user, odoo_user
+            )
+
+    # Log and write the (un)assignments of all orders at once
+    for messages, user_id in ((accepts, odoo_user.id), (unassigns, False)):
+        if not messages:
+            continue
+        batch_orders = orders.browse(list(messages))
+        pickings = batch_orders.picking_ids
+        pickings._message_log_batch(
+            {o.picking_ids.id: messages[o.id] for o in batch_orders}
+        )
+        batch_orders._message_log_batch(messages)
+        pickings.write({"user_id": user_id})
+
+    # Validating a picking may fail on its own
+    for order_obj, request_body, result in drop_offs:
+        try:
+            with env.cr.savepoint():
+                for message in drop_off_messages(request_body, current_user, odoo_user):
+                    order_obj._message_log(body=message)
+                order_obj.picking_ids.button_validate()
+        except (odoo.exceptions.UserError, odoo.exceptions.ValidationError) as e:
+            result.status_code, result.error, result.object_id = 400, str(e), None
+    return request_idempotency.remember(results)
+
+
+def parse_order_fields(fields: Optional[str]) -> Optional[Set[str]]:
+    """Optional order fields asked for in the `fields` query parameter"""
+    if fields is None:
+        return None
+    names = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = names - ORDER_CORE_FIELDS - ORDER_OPTIONAL_FIELDS
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+        )
+    return names - ORDER_CORE_FIELDS
+
+
+def picking_state_domain(
+    state: List[PickingState], user_id: int, prefix: str = "picking_ids."
+) -> list:
+    """Build the domain matching the picking `state` filters of a driver.
+
+    :param state: Requested picking states. `unassigned` matches the pickings
+        ready for delivery (assigned) that have no responsible yet. Any other
+        state only matches the pickings of `user_id`.
+    :param user_id: Odoo user id of the driver
+    :param prefix: Path from the searched model to the picking fields,
+        e.g. "picking_ids." for `sale.order` or "" for `stock.picking`
+    :return: Odoo domain
+    """
+    states = [s.value for s in state if s != PickingState.unassigned]
+    domains = []
+    if states:
+        domains.append(
+            [
+                (f"{prefix}state", "in", states),
+                (f"{prefix}user_id", "=", user_id),
+            ]
+        )
+    if PickingState.unassigned in state:
+        # Picking status is "ready" (assigned) but no one really is set as responsible
+        domains.append(
+            [
+                "|",
+                (f"{prefix}state", "=", False),
+                "&",
+                (f"{prefix}state", "=", PickingState.assigned.value),
+                (f"{prefix}user_id", "=", False),
+            ]
+        )
+    if not domains:
+        return expression.FALSE_DOMAIN
+    return expression.OR(domains)
+
+
+def orders_etag(
+    env: odoo.api.Environment,
+    state: List[PickingState],
+    user_id: int,
+    fields: Optional[Set[str]],
+    *extra,
+) -> str:
+    """Weak ETag of the orders matching the picking `state` filters of a driver.
+
+    Derived from the count, last id and row versions of the matching orders,
+    their pickings and lines, and the partners of their delivery address when
+    it is asked for, which is much cheaper than serializing them.
+    `extra` are the other parameters the response depends on (e.g. the page).
+    """
+    SaleOrder = env["sale.order"]
+    domain = expression.AND(
+        [[("picking_ids", "!=", False)], picking_state_domain(state, user_id)]
+    )
+    SaleOrder._flush_search(domain)
+    matching, params = SaleOrder._where_calc(domain).select(
+        '"sale_order"."id" AS id',
+        '"sale_order"."xmin" AS xmin',
+        '"sale_order"."partner_id" AS partner_id',
+        '"sale_order"."partner_shipping_id" AS partner_shipping_id',
+    )
+    # xmin is the transaction that wrote the row version, so it changes with
+    # every committed write. Not write_date: Odoo sets it to the start of the
+    # transaction, which may commit after a poll that saw an older maximum.
+    summary = "json_build_array(COUNT(*), MAX({0}.id), SUM({0}.xmin::text::bigint))"
+    partners = "NULL"
+    if fields is None or "delivery_address" in fields:
+        partners = f"""(
+            SELECT {summary.format("rp")} FROM res_partner rp
+             WHERE rp.id IN (SELECT partner_id FROM orders)
+                OR rp.id IN (SELECT partner_shipping_id FROM orders)
+                -- Delivery contacts of the shipping partners
+                OR rp.parent_id IN (SELECT partner_shipping_id FROM orders)
+        )"""
+    env.cr.execute(
+        f"""
+        WITH orders AS ({matching})
+        SELECT
+            (SELECT {summary.format("o")} FROM orders o),
+            (
+                SELECT {summary.format("p")} FROM stock_picking p
+                  JOIN orders o ON p.sale_id = o.id
+            ),
+            (
+                SELECT {summary.format("l")} FROM sale_order_line l
+                  JOIN orders o ON l.order_id = o.id
+            ),
+            {partners}
+        """,
+        params,
+    )
+    parts = [
+        user_id,
+        sorted(s.value for s in state),
+        fields and sorted(fields),
+        *extra,
+        *env.cr.fetchone(),
+    ]
+    digest = hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+    return f'W/"{digest}"'
+
+
+@router.get("/", response_model=Page[Order], response_model_exclude_unset=True)
+def list_orders(
     state: Optional[list[PickingState]] = Query(
         default=[PickingState.assigned],
         # choices=[s.value for s in PickingState],
         choices=[s.value for s in PickingState],
         description=STATE_DESCRIPTION,
     ),
-    env: odoo.api.Environment = Depends(odoo_env),
+    fields: Optional[str] = Query(default=None, description=ORDER_FIELDS_DESCRIPTION),
+    principal: Principal = Security(get_current_principal, scopes=["orders:list"]),
+    if_none_match: Optional[str] = Header(default=None),
+):
+    env, odoo_user = principal.env, principal.odoo_user
+    order_fields = parse_order_fields(fields)
+    params = resolve_params()
+    # Unchanged since the last poll of the client
+    etag = orders_etag(env, state, odoo_user.id, order_fields, params.page, params.size)
+    if utils.etag_matches(if_none_match, etag):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+        )
+    domain = expression.AND(
+        [
+            # Must only return those that have pickings already
+            [("picking_ids", "!=", False)],
+            picking_state_domain(state, odoo_user.id),
+        ]
+    )
+    # Let the database count, limit and offset instead of paginating in memory
+    raw_params = params.to_raw_params()
+    SaleOrder = env["sale.order"]
+    total = SaleOrder.search_count(domain)
+    orders = SaleOrder.search(domain, limit=raw_params.limit, offset=raw_params.offset)
+    page = create_page(Order.from_sale_orders(orders, env, order_fields), total, params)
+    return utils.model_response(page, headers={"ETag": etag})
+
+
+def _decode_order_cursor(cursor: str):
+    """Decode the (scheduled date or None, picking id) starting the last order"""
+    scheduled_date, picking_id = json.loads(cursor)
+    return odoo.fields.Datetime.to_datetime(scheduled_date), int(picking_id)
+
+
+def _encode_order_cursor(scheduled_date: Optional[datetime], picking_id: int) -> str:
+    return json.dumps(
+        [scheduled_date and odoo.fields.Datetime.to_string(scheduled_date), picking_id]
+    )
+
+
+_PICKING_KEY_COLUMNS = (
+    '"stock_picking"."sale_id"',
+    '"stock_picking"."scheduled_date"',
+    '"stock_picking"."id"',
+)
+
+
+def _pickings_after(
+    env: odoo.api.Environment, picking_domain: list, position, limit: int
+) -> list:
+    """(order id, scheduled date, picking id) of the next `limit` pickings.
+
+    Keyset over the index of `scheduled_date`, then over the ids of the
+    pickings without one, which come last.
+    """
+    Picking = env["stock.picking"]
+    rows = []
+    scheduled_date, picking_id = position or (None, None)
+    if position is None or scheduled_date is not None:
+        query = Picking._where_calc(picking_domain)
+        query.add_where('"stock_picking"."scheduled_date" IS NOT NULL')
+        if position:
+            query.add_where(
+                '("stock_picking"."scheduled_date", "stock_picking"."id") > (%s, %s)',
+                [scheduled_date, picking_id],
+            )
+        query.order = '"stock_picking"."scheduled_date", "stock_picking"."id"'
+        query.limit = limit
+        env.cr.execute(*query.select(*_PICKING_KEY_COLUMNS))
+        rows = env.cr.fetchall()
+    if len(rows) < limit:
+        query = Picking._where_calc(picking_domain)
+        query.add_where('"stock_picking"."scheduled_date" IS NULL')
+        if scheduled_date is None and picking_id is not None:
+            query.add_where('"stock_picking"."id" > %s', [picking_id])
+        query.order = '"stock_picking"."id"'
+        query.limit = limit - len(rows)
+        env.cr.execute(*query.select(*_PICKING_KEY_COLUMNS))
+        rows += env.cr.fetchall()
+    return rows
+
+
+def _orders_before(
+    env: odoo.api.Environment, picking_domain: list, position, order_ids: list
+) -> Set[int]:
+    """Orders among `order_ids` with a picking matching up to `position`"""
+    scheduled_date, picking_id = position
+    query = env["stock.picking"]._where_calc(picking_domain)
+    query.add_where('"stock_picking"."sale_id" IN %s', [tuple(order_ids)])
+    if scheduled_date is None:
+        query.add_where(
+            '("stock_picking"."scheduled_date" IS NOT NULL '
+            'OR "stock_picking"."id" <= %s)',
+            [picking_id],
+        )
+    else:
+        query.add_where(
+            '("stock_picking"."scheduled_date", "stock_picking"."id") <= (%s, %s)',
+            [scheduled_date, picking_id],
+        )
+    env.cr.execute(*query.select('DISTINCT "stock_picking"."sale_id"'))
+    return {order_id for order_id, in env.cr.fetchall()}
+
+
+def _orders_page_by_scheduled_date(
+    env: odoo.api.Environment, picking_domain: list, cursor, limit: int
+) -> list:
+    """(order id, scheduled date, picking id) of the orders after `cursor`.
+
+    An order is sorted by its first picking matching `picking_domain`, by
+    scheduled date then id, so that it is on a single page even with several
+    of them. Orders without a scheduled date come last. The pickings are read
+    in that order from the cursor on, a page at a time: the cost of a page
+    depends on its size and on the pickings of its orders, not on its depth.
+    """
+    Picking = env["stock.picking"]
+    Picking._flush_search(picking_domain, fields=["sale_id", "scheduled_date"])
+    page, seen, position = [], set(), cursor
+    while len(page) < limit:
+        rows = _pickings_after(env, picking_domain, position, limit)
+        if not rows:
+            break
+        position = rows[-1][1:]
+        new_ids = list({order_id for order_id, *__ in rows} - seen)
+        # Already on a previous page, at the cursor or an earlier picking
+        seen.update(
+            _orders_before(env, picking_domain, cursor, new_ids)
+            if cursor and new_ids
+            else ()
+        )
+        for order_id, scheduled_date, picking_id in rows:
+            if order_id not in seen:
+                seen.add(order_id)
+                page.append((order_id, scheduled_date, picking_id))
+        if len(rows) < limit:
+            break
+    return page[:limit]
+
+
+@router.get(
+    "/cursor", response_model=CursorPage[Order], response_model_exclude_unset=True
+)
+def list_orders_by_cursor(
+    state: Optional[list[PickingState]] = Query(
+        default=[PickingState.assigned],
+        choices=[s.value for s in PickingState],
+        description=STATE_DESCRIPTION,
+    ),
+    fields: Optional[str] = Query(default=None, description=ORDER_FIELDS_DESCRIPTION),
+    principal: Principal = Security(get_current_principal, scopes=["orders:list"]),
+    if_none_match: Optional[str] = Header(default=None),
+):
+    """Same orders as `GET /orders/`, by scheduled date, paginated with a cursor.
+
+    Pass `next_page` of a response as `cursor` to get the following orders.
+    Unlike page numbers, the cursor does not skip nor repeat orders when
+    others change state in between, and reading a page does not get slower
+    further in the list.
+    """
+    env, odoo_user = principal.env, principal.odoo_user
+    order_fields = parse_order_fields(fields)
+    domain = expression.AND(
+        [
+            # Must only return those that have pickings already
+            [("sale_id", "!=", False)],
+            picking_state_domain(state, odoo_user.id, prefix=""),
+        ]
+    )
+    params = resolve_params()
+    try:
+        raw_params = params.to_raw_params()
+        cursor = raw_params.cursor and _decode_order_cursor(raw_params.cursor)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor. {str(e)}")
+    # Unchanged since the last poll of the client
+    etag = orders_etag(
+        env, state, odoo_user.id, order_fields, params.cursor, params.size
+    )
+    if utils.etag_matches(if_none_match, etag):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag}
+        )
+    # One more to know whether there is a next page
+    rows = _orders_page_by_scheduled_date(env, domain, cursor, raw_params.size + 1)
+    next_cursor = None
+    if len(rows) > raw_params.size:
+        rows = rows[: raw_params.size]
+        next_cursor = _encode_order_cursor(rows[-1][1], rows[-1][2])
+    orders = env["sale.order"].browse([order_id for order_id, *__ in rows])
+    page = create_page(
+        Order.from_sale_orders(orders, env, order_fields),
+        params=params,
+        next_=next_cursor,
+    )
+    return utils.model_response(page, headers={"ETag": etag})
+
+
+# Rows are stamped with the start time of their transaction, and may be
+# committed after a later sync. Changes that close to the watermark are
+# returned again by the next sync.
+CHANGES_OVERLAP_SECONDS = int(SETTINGS.get("ORDER_CHANGES_OVERLAP_SECONDS", "60"))
+
+
+class OrderChanges(BaseModel):
+    changed: List[Order]
+    removed: List[int] = Field(
+        description="Orders that changed and left the requested states, "
+        "to remove from the local copy. May include orders never received."
+    )
+    since: str = Field(description="Watermark to send as `since` on the next sync")
+
+
+def _decode_changes_token(token: str) -> datetime:
+    try:
+        since = odoo.fields.Datetime.to_datetime(
+            base64.urlsafe_b64decode(token.encode()).decode()
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid since. {str(e)}")
+    # E.g. padding only, which would compare write dates with NULL
+    if not since:
+        raise HTTPException(status_code=400, detail="Invalid since. Empty date")
+    return since
+
+
+def _encode_changes_token(watermark: datetime) -> str:
+    value = odoo.fields.Datetime.to_string(watermark)
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+@router.get("/changes", response_model=OrderChanges, response_model_exclude_unset=True)
+def order_changes(
+    since: Optional[str] = Query(
+        default=None,
+        min_length=1,
+        description="Watermark returned by the previous sync. "
+        "Without it, all the orders are returned.",
+    ),
+    state: Optional[list[PickingState]] = Query(
+        default=[PickingState.assigned],
+        choices=[s.value for s in PickingState],
+        description=STATE_DESCRIPTION,
+    ),
+    fields: Optional[str] = Query(default=None, description=ORDER_FIELDS_DESCRIPTION),
+    principal: Principal = Security(get_current_principal, scopes=["orders:list"]),
+):
+    """Orders changed since the previous sync of the client.
+
+    An order changed when it, its pickings, its lines, its customer, its
+    delivery partner or the contacts of the latter were written since the
+    `since` watermark. Orders may be returned again
+    by the next sync.
+    """
+    env, odoo_user = principal.env, principal.odoo_user
+    order_fields = parse_order_fields(fields)
+    # Transaction start time, as `write_date` of the rows written after it
+    watermark = env.cr.now() - timedelta(seconds=CHANGES_OVERLAP_SECONDS)
+    SaleOrder = env["sale.order"]
+    in_view = expression.AND(
+        [[("picking_ids", "!=", False)], picking_state_domain(state, odoo_user.id)]
+    )
+    if since is None:
+        orders, removed = SaleOrder.search(in_view), []
+    else:
+        since_date = _decode_changes_token(since)
+        changed = expression.OR(
+            [
+                [(f"{path}write_date", ">", since_date)]
+                for path in (
+                    "",
+                    "picking_ids.",
+                    "order_line.",
+                    # The partners of the delivery address, as in `orders_etag`:
+                    # the customer, for its coordinates, the shipping partner
+                    # and its delivery contacts
+                    "partner_id.",
+                    "partner_shipping_id.",
+                    "partner_shipping_id.child_ids.",
+                )
+            ]
+        )
+        orders = SaleOrder.search(expression.AND([in_view, changed]))
+        # Orders only leave the view through their pickings
+        left = (
+            env["stock.picking"]
+            .search([("write_date", ">", since_date), ("sale_id", "!=", False)])
+            .sale_id
+            - orders
+        )
+        still_in_view = SaleOrder.search(
+            expression.AND([in_view, [("id", "in", left.ids)]])
+        )
+        removed = (left - still_in_view).ids
+    return utils.model_response(
+        OrderChanges(
+            changed=Order.from_sale_orders(orders, env, order_fields),
+            removed=removed,
+            since=_encode_changes_token(watermark),
+        )
+    )
+
+
+def unassigned_order_coordinates(
+    env: odoo.api.Environment, order_ids: Optional[List[int]] = None
+) -> Dict[int, "geo.Coordinates"]:
+    """Delivery coordinates of the unassigned orders, among `order_ids` if given"""
+    domain = expression.AND(
+        [
+            [("picking_ids", "!=", False)],
+            picking_state_domain([PickingState.unassigned], odoo.SUPERUSER_ID),
+        ]
+    )
+    if order_ids is not None:
+        domain = expression.AND([domain, [("id", "in", order_ids)]])
+    orders = env["sale.order"].search(domain)
+    return {
+        order_id: (address.partner_latitude, address.partner_longitude)
+        for order_id, address in PartnerDeliveryAddress.from_sale_orders(
+            orders, env
+        ).items()
+        # Unknown coordinates are read as 0
+        if address.partner_latitude or address.partner_longitude
+    }
+
+
+class NearbyOrder(BaseModel):
+    order_id: int
+    distance_km: float
+    latitude: float
+    longitude: float
+
+
+@router.get("/nearby", response_model=List[NearbyOrder])
+async def nearby_orders(
+    lat: float = Query(ge=-90, le=90),
+    lon: float = Query(ge=-180, le=180),
+    radius: float = Query(default=10, gt=0, le=500, description="In km"),
+    limit: int = Query(default=50, ge=1, le=500),
     current_user: User = Security(get_current_active_user, scopes=["orders:list"]),
 ):
-    domain = [
-        ("picking_ids", "!=", False)
-    ]  # Must only return those that have pickings already
-    all_orders = env["sale.order"].search(domain)
-    # Filtering from state
-    show_unassigned = False
-    if "unassigned" in state:
-        state.pop(state.index("unassigned"))
-        show_unassigned = True
-    # Filtering other states should only include the user's
-    __, odoo_user = get_odoo_user(current_user.username)
-    orders = all_orders.filtered(
-        lambda o: o.picking_ids.state in state
-        and o.picking_ids.user_id.id == odoo_user.id
+    """Unassigned orders delivered within `radius` of (`lat`, `lon`), nearest first.
+
+    Answered from an index kept in memory, which may lag behind the orders
+    by a moment. Use `GET /orders/{order_id}` for the details of an order.
+    """
+    if not geo.nearby_orders.ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Orders are being indexed",
+            headers={"Retry-After": "5"},
+        )
+    return [
+        NearbyOrder(
+            order_id=order_id,
+            distance_km=round(distance, 3),
+            latitude=latitude,
+            longitude=longitude,
+        )
+        for order_id, distance, (latitude, longitude) in geo.nearby_orders.index.nearby(
+            lat, lon, radius, limit
+        )
+    ]
+
+
+class RouteStop(BaseModel):
+    order_id: int
+    latitude: float
+    longitude: float
+    distance_km: float = Field(description="From the previous stop, or the driver")
+
+
+class Route(BaseModel):
+    stops: List[RouteStop]
+    distance_km: float
+    unlocated: List[int] = Field(
+        description="Assigned orders without delivery coordinates, not in the route"
     )
-    if show_unassigned:
-        # Picking status is "ready" (assigned) but no one really is set as responsible
-        orders |= all_orders.filtered(
-            lambda o: not o.picking_ids.state
-            or (
-                o.picking_ids.state == PickingState.assigned
-                and o.picking_ids.user_id.id is False
+    optimized: bool = Field(
+        description="False when the time budget ran out before 2-opt converged"
+    )
+
+
+@router.get("/route", response_model=Route)
+def order_route(
+    lat: float = Query(ge=-90, le=90, description="Current position of the driver"),
+    lon: float = Query(ge=-180, le=180),
+    principal: Principal = Security(get_current_principal, scopes=["orders:list"]),
+):
+    """Order in which to deliver the assigned orders of the driver, from their position"""
+    env, odoo_user = principal.env, principal.odoo_user
+    domain = expression.AND(
+        [
+            [("picking_ids", "!=", False)],
+            picking_state_domain([PickingState.assigned], odoo_user.id),
+        ]
+    )
+    orders = env["sale.order"].search(domain)
+    addresses = PartnerDeliveryAddress.from_sale_orders(orders, env)
+    located, unlocated = [], []
+    for order in orders:
+        address = addresses.get(order.id)
+        if address and (address.partner_latitude or address.partner_longitude):
+            located.append(
+                (order.id, (address.partner_latitude, address.partner_longitude))
             )
+        else:
+            unlocated.append(order.id)
+    visits, legs, optimized = routing.sequence(
+        (lat, lon), [coordinates for __, coordinates in located]
+    )
+    stops = [
+        RouteStop(
+            order_id=located[index][0],
+            latitude=located[index][1][0],
+            longitude=located[index][1][1],
+            distance_km=round(leg, 3),
+        )
+        for index, leg in zip(visits, legs)
+    ]
+    return utils.model_response(
+        Route(
+            stops=stops,
+            distance_km=round(sum(legs), 3),
+            unlocated=unlocated,
+            optimized=optimized,
         )
-    # TODO Paginate `orders` instead?
-    # TODO BUG size is returning length of array instead of matched states/query. total and size are both correct.
-    return paginate([Order.from_sale_order(order, env) for order in orders])
+    )
+
+
+@router.get(
+    "/events",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {}}}},
+)
+async def order_events(
+    current_user: User = Security(get_current_active_user, scopes=["orders:list"]),
+    last_event_id: Optional[str] = Header(default=None),
+):
+    """Server-sent events of the changes of the unassigned orders.
+
+    - `added`: an order became unassigned
+    - `taken`: an unassigned order was accepted by a driver
+    - `removed`: an unassigned order was cancelled, or is no longer ready
+    - `reset`: changes may have been missed, fetch the unassigned orders again
+
+    Their data is the `order_id`, `picking_id` and picking `state`. Streams
+    end after a while: reconnect with the `Last-Event-ID` header to receive
+    the events missed meanwhile.
+    """
+    return StreamingResponse(
+        events.stream(last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Must come after the other GET routes, "/{order_id}" would match them too.
+@router.get("/{order_id}", response_model=Order, response_model_exclude_unset=True)
+def get_order(
+    order_id: int,
+    fields: Optional[str] = Query(default=None, description=ORDER_FIELDS_DESCRIPTION),
+    principal: Principal = Security(get_current_principal, scopes=["orders:list"]),
+):
+    """One order, if assigned to the requestor or unassigned."""
+    env, odoo_user = principal.env, principal.odoo_user
+    order_fields = parse_order_fields(fields)
+    domain = expression.AND(
+        [
+            [("id", "=", order_id), ("picking_ids", "!=", False)],
+            picking_state_domain(list(PickingState), odoo_user.id),
+        ]
+    )
+    order = env["sale.order"].search(domain)
+    if not order:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return utils.model_response(Order.from_sale_orders(order, env, order_fields)[0])
@@ -1,11 +1,10 @@
-from collections import namedtuple
-from datetime import datetime
+from datetime import datetime, time
 
 import odoo
-from fastapi import APIRouter, Depends, Security
+from fastapi import APIRouter, Security
 from pydantic import BaseModel
 
-from app.dependencies import User, get_current_active_user, get_odoo_user, odoo_env
+from app.dependencies import Principal, get_current_principal
 
 router = APIRouter(
     tags=["stats"],
@@ -24,49 +23,52 @@ class Statistics(BaseModel):
 
 
 @router.get("/users/stats/", response_model=Statistics)
-async def stats(
-    env: odoo.api.Environment = Depends(odoo_env),
-    current_user: User = Security(get_current_active_user, scopes=["me_profile"]),
+def stats(
+    principal: Principal = Security(get_current_principal, scopes=["me_profile"]),
 ):
     """User statistics"""
-    __, odoo_user = get_odoo_user(current_user.username)
-    order_stats = get_order_stats(env, odoo_user)
+    order_stats = get_order_stats(principal.env, principal.odoo_user)
     return Statistics(orders=OrderStats(**order_stats))
 
 
-Message = namedtuple("Message", "message, timestamp")
-
-
 def get_order_stats(env: odoo.api.Environment, user):
     domain = [
         ("picking_ids", "!=", False)
     ]  # Must only return those that have pickings already
     # Get quick counts
-    all_orders = env["sale.order"].search(domain)
-    assigned = all_orders.filtered(lambda o: o.picking_ids.user_id.id == user.id)
-    completed = all_orders.filtered(
-        lambda o: o.picking_ids.user_id.id == user.id and o.picking_ids.state == "done"
+    SaleOrder = env["sale.order"]
+    assigned = SaleOrder.search_count(domain + [("picking_ids.user_id", "=", user.id)])
+    completed = SaleOrder.search_count(
+        domain
+        + [
+            ("picking_ids.user_id", "=", user.id),
+            ("picking_ids.state", "=", "done"),
+        ]
     )
-    # Get status from message logs
+    # Get status from message logs, only looking at the current month
     today = datetime.now()
-    start_of_month = today.replace(day=1).date()
-    completed_messages = []
-    for _order in all_orders:
-        drop_off_message = None
-        assignment_message = None
-        # Retrieve from messages
-        for message in _order.message_ids.filtered(
-            lambda m: user in m.author_id.user_ids and m.date.date() >= start_of_month
-        ):
-            if drop_off_message is None and "Drop off by" in message.body:
-                drop_off_message = Message(message=message.body, timestamp=message.date)
-        # Save messages
-        if drop_off_message:
-            completed_messages.append(drop_off_message)
+    start_of_month = datetime.combine(today.replace(day=1).date(), time.min)
+    env["mail.message"].flush_model(["model", "res_id", "author_id", "date", "body"])
+    env["stock.picking"].flush_model(["sale_id"])
+    env.cr.execute(
+        """
+        SELECT COUNT(DISTINCT m.res_id)
+          FROM mail_message m
+         WHERE m.model = 'sale.order'
+           AND m.author_id = %s
+           AND m.date >= %s
+           AND m.body ILIKE %s
+           AND EXISTS (
+               SELECT 1 FROM stock_picking p WHERE p.sale_id = m.res_id
+           )
+        """,
+        (user.partner_id.id, start_of_month, "%Drop off by%"),
+    )
+    (completed_in_month,) = env.cr.fetchone()
 
     return dict(
-        assigned=len(assigned),
-        completed=len(completed),
-        completed_in_month=len(completed_messages),
+        assigned=assigned,
+        completed=completed,
+        completed_in_month=completed_in_month,
         current_period=today.strftime("%B %Y"),
     )
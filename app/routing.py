@@ -0,0 +1,138 @@
+"""Sequencing of the delivery stops of a driver.
+
+The route starts at the driver and visits every stop once, without coming
+back. It is built by nearest neighbour, then shortened by 2-opt moves until
+none improves it or the time budget is spent. Both work on a distance
+matrix computed at once with NumPy, and cached for a given set of stops.
+"""
+import math
+import time
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from .cache import TTLCache
+from .settings import SETTINGS
+
+EARTH_RADIUS_KM = 6371.0088
+TIME_BUDGET_SECONDS = float(SETTINGS.get("ROUTE_TIME_BUDGET_MS", "50")) / 1000
+
+# Tuple of stop coordinates -> distance matrix between them
+matrix_cache = TTLCache(maxsize=256, ttl=3600, clear_on_signaling=False)
+
+
+def pairwise_haversine_km(lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Matrix of the great-circle distances between all the points"""
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = (
+        np.sin((lats[:, None] - lats[None, :]) / 2) ** 2
+        + np.cos(lats)[:, None]
+        * np.cos(lats)[None, :]
+        * np.sin((lons[:, None] - lons[None, :]) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def stops_matrix(stops: Sequence[Tuple[float, float]]) -> np.ndarray:
+    key = tuple(stops)
+    matrix = matrix_cache.get(key)
+    if matrix is None:
+        coordinates = np.array(stops, dtype=float).reshape(-1, 2)
+        matrix = pairwise_haversine_km(coordinates[:, 0], coordinates[:, 1])
+        matrix.setflags(write=False)
+        matrix_cache.set(key, matrix)
+    return matrix
+
+
+def route_matrix(
+    start: Tuple[float, float], stops: Sequence[Tuple[float, float]]
+) -> np.ndarray:
+    """Distances between the start (0), the stops (1..n) and a free end (n + 1).
+
+    The end is at distance 0 of every node, so that a closed tour through it
+    is an open path from the start. Only the distances from the start are
+    computed again when the driver moves.
+    """
+    n = len(stops)
+    matrix = np.zeros((n + 2, n + 2))
+    matrix[1 : n + 1, 1 : n + 1] = stops_matrix(stops)
+    coordinates = np.array([start, *stops], dtype=float)
+    lats, lons = np.radians(coordinates[:, 0]), np.radians(coordinates[:, 1])
+    a = (
+        np.sin((lats - lats[0]) / 2) ** 2
+        + math.cos(lats[0]) * np.cos(lats) * np.sin((lons - lons[0]) / 2) ** 2
+    )
+    from_start = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    matrix[0, : n + 1] = matrix[: n + 1, 0] = from_start
+    return matrix
+
+
+def nearest_neighbour(matrix: np.ndarray) -> np.ndarray:
+    """Path from node 0 always going to the nearest unvisited node, ending at the last"""
+    size = len(matrix)
+    path = np.empty(size, dtype=int)
+    path[0], path[-1] = 0, size - 1
+    visited = np.zeros(size, dtype=bool)
+    visited[[0, size - 1]] = True
+    current = 0
+    for position in range(1, size - 1):
+        distances = np.where(visited, np.inf, matrix[current])
+        current = int(np.argmin(distances))
+        visited[current] = True
+        path[position] = current
+    return path
+
+
+def two_opt(matrix: np.ndarray, path: np.ndarray, deadline: float) -> bool:
+    """Apply the best 2-opt move to `path` in place until none improves it.
+
+    Both ends of the path stay in place. Return whether it converged before
+    the `deadline` (in `time.perf_counter()` seconds).
+    """
+    n = len(path) - 2
+    if n < 2:
+        return True
+    upper = np.triu(np.ones((n, n), dtype=bool), k=1)
+    while time.perf_counter() < deadline:
+        # Reversing path[i..j] replaces the edges (i-1, i) and (j, j+1) by
+        # (i-1, j) and (i, j+1), for 1 <= i < j <= n. Row a of the deltas is
+        # i = a + 1, column b is j = b + 1.
+        previous, inner, following = path[:n], path[1 : n + 1], path[2:]
+        delta = (
+            matrix[previous[:, None], inner[None, :]]
+            + matrix[inner[:, None], following[None, :]]
+            - matrix[previous, inner][:, None]
+            - matrix[inner, following][None, :]
+        )
+        delta[~upper] = 0.0
+        best = int(np.argmin(delta))
+        if delta.flat[best] > -1e-9:
+            return True
+        a, b = divmod(best, n)
+        path[a + 1 : b + 2] = path[a + 1 : b + 2][::-1].copy()
+    return False
+
+
+def sequence(
+    start: Tuple[float, float],
+    stops: Sequence[Tuple[float, float]],
+    time_budget: float = TIME_BUDGET_SECONDS,
+) -> Tuple[List[int], List[float], bool]:
+    """Order in which to visit `stops` from `start`.
+
+    :return: Indexes of the stops in visiting order, distance in km of each
+        leg, and whether 2-opt converged within the time budget
+    """
+    deadline = time.perf_counter() + time_budget
+    if not stops:
+        return [], [], True
+    matrix = route_matrix(start, stops)
+    path = nearest_neighbour(matrix)
+    converged = two_opt(matrix, path, deadline)
+    visits = path[:-1]
+    legs = matrix[visits[:-1], visits[1:]]
+    return (
+        [int(node) - 1 for node in visits[1:]],
+        [float(leg) for leg in legs],
+        converged,
+    )
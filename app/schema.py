@@ -0,0 +1,53 @@
+"""Tables of the API itself, in the Odoo database.
+
+They hold the state every API process must share, and are created at
+startup when missing. Their names start with `nextway_api_`, and Odoo
+ignores them.
+"""
+TABLES = [
+    # Idempotency keys of the order mutations and their responses, see
+    # `app.idempotency`
+    """
+    CREATE TABLE IF NOT EXISTS nextway_api_idempotency_key (
+        id serial PRIMARY KEY,
+        username varchar NOT NULL,
+        scope varchar NOT NULL,
+        key varchar NOT NULL,
+        fingerprint varchar NOT NULL,
+        status_code integer,
+        response jsonb,
+        created_at timestamp NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+        UNIQUE (username, scope, key)
+    )
+    """,
+    # Background jobs, see `app.jobs`
+    """
+    CREATE TABLE IF NOT EXISTS nextway_api_job (
+        id varchar PRIMARY KEY,
+        username varchar NOT NULL,
+        order_id integer NOT NULL,
+        name varchar NOT NULL,
+        arguments jsonb NOT NULL,
+        status varchar NOT NULL DEFAULT 'pending',
+        error text,
+        created_at timestamp NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+        finished_at timestamp
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS nextway_api_job_unfinished_idx
+        ON nextway_api_job (created_at) WHERE status IN ('pending', 'running')
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS nextway_api_job_finished_idx
+        ON nextway_api_job (finished_at) WHERE finished_at IS NOT NULL
+    """,
+]
+
+
+def install(cr):
+    """Create the missing tables. Call once at startup."""
+    # Workers start together: let one create the tables while the others wait
+    cr.execute("SELECT pg_advisory_xact_lock(hashtext('nextway_api_schema'))")
+    for sql in TABLES:
+        cr.execute(sql)
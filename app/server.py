@@ -0,0 +1,110 @@
+"""Production server.
+
+Imports the API and loads the Odoo registry of `db_name` once, then forks the
+workers, which share that memory copy-on-write and serve their first request
+with a warm registry.
+
+    $ env ODOO_RC=/path/to/odoo.conf python -m app.server
+"""
+import gc
+import logging
+import os
+import signal
+import time
+
+import odoo
+import uvicorn
+
+from .dependencies import configure_odoo
+from .settings import SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# A worker exiting sooner than that after its start crashed on boot (bad
+# configuration, database down, ...): wait before forking it again, longer
+# after each such crash in a row, so that it doesn't become a fork loop.
+MIN_UPTIME_SECONDS = 10
+RESPAWN_BACKOFF_SECONDS = 0.5
+MAX_RESPAWN_BACKOFF_SECONDS = 30
+
+
+def preload_registry():
+    # Read Odoo config from $ODOO_RC.
+    odoo.tools.config.parse_config([])
+    configure_odoo()
+    registry = odoo.registry(odoo.tools.config["db_name"])
+    # Workers must not share the database connections of the parent
+    odoo.sql_db.close_all()
+    return registry
+
+
+def fork_worker(config: uvicorn.Config, sockets: list) -> int:
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            uvicorn.Server(config).run(sockets=sockets)
+        finally:
+            os._exit(0)
+    logger.info("[.] Started worker %s", pid)
+    return pid
+
+
+def serve():
+    workers = int(SETTINGS.get("API_WORKERS", str(os.cpu_count() or 1)))
+    config = uvicorn.Config(
+        "app.main:app",
+        host=SETTINGS.get("API_HOST", "0.0.0.0"),
+        port=int(SETTINGS.get("API_PORT", "8082")),
+        proxy_headers=True,
+    )
+    # Import the application and build the registry before forking
+    config.load()
+    preload_registry()
+    sockets = [config.bind_socket()]
+    # Keep the preloaded objects out of the garbage collector, whose passes
+    # would otherwise touch (and copy) every shared page in each worker.
+    gc.freeze()
+
+    # Worker pid -> when it was forked
+    children = {fork_worker(config, sockets): time.monotonic() for __ in range(workers)}
+    boot_crashes = 0
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started_at = children.pop(pid, None)
+        if stopping or started_at is None:
+            continue
+        if time.monotonic() - started_at < MIN_UPTIME_SECONDS:
+            boot_crashes += 1
+            delay = min(
+                RESPAWN_BACKOFF_SECONDS * 2 ** (boot_crashes - 1),
+                MAX_RESPAWN_BACKOFF_SECONDS,
+            )
+        else:
+            boot_crashes, delay = 0, 0
+        logger.warning(
+            "[!] Worker %s exited (%s), restarting in %ss", pid, status, delay
+        )
+        deadline = time.monotonic() + delay
+        while not stopping and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if not stopping:
+            children[fork_worker(config, sockets)] = time.monotonic()
+
+
+if __name__ == "__main__":
+    serve()
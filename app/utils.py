@@ -2,11 +2,20 @@
 # Copyright 2021 ACSONE SA/NV
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html)
 
-from typing import Any
+import functools
+from typing import Any, Optional
 
+import pydantic
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from odoo import fields, models
 from pydantic.utils import GetterDict
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 
 class GenericOdooGetter(GetterDict):
     """A generic GetterDict for Odoo models
@@ -66,3 +75,48 @@ class GenericOdooGetter(GetterDict):
             if field.type in ["one2many", "many2many"]:
                 return list(res)
         return res
+
+
+@functools.lru_cache(maxsize=256)
+def _boolean_fields(model_class) -> frozenset:
+    return frozenset(
+        name for name, field in model_class._fields.items() if field.type == "boolean"
+    )
+
+
+def read_values(model: models.BaseModel, values: dict) -> dict:
+    """Cast a row returned by `read(fields, load=None)` like GenericOdooGetter does
+
+    Odoo uses `False` for empty values; those become `None` for every field
+    but booleans. Datetimes are returned as read, in UTC.
+    """
+    booleans = _boolean_fields(type(model))
+    return {
+        key: None if value is False and key not in booleans else value
+        for key, value in values.items()
+    }
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an `If-None-Match` header matches `etag`, using weak comparison"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(
+        tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(",")
+    )
+
+
+def model_response(model: pydantic.BaseModel, **kwargs) -> Response:
+    """JSON response of an already validated model.
+
+    Returning a response skips the validation against `response_model` and
+    `jsonable_encoder` that FastAPI would otherwise run on the model again.
+    The body is the same as with `response_model_exclude_unset=True`.
+    """
+    content = model.dict(exclude_unset=True)
+    if orjson is None:
+        return JSONResponse(jsonable_encoder(content), **kwargs)
+    return ORJSONResponse(content, **kwargs)
@@ -0,0 +1,131 @@
+"""Throughput of concurrent `POST /orders/{order_id}/accept`.
+
+Every unassigned order is accepted by `--concurrency` simultaneous requests
+of the given drivers. Exactly one of them must win each order; the others
+must fail fast with a 409 (or a 404 once the winner committed) instead of
+waiting for the winner or failing with a database error.
+
+Runs against a running API, on a database whose unassigned orders can be
+accepted:
+
+    $ python benchmarks/accept_concurrency.py --url http://localhost:8082 \\
+        --user driver1:password1 --user driver2:password2 --concurrency 8
+"""
+import argparse
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def login(url: str, credentials: str) -> str:
+    username, password = credentials.split(":", 1)
+    response = requests.post(
+        f"{url}/token",
+        data={
+            "username": username,
+            "password": password,
+            "scope": "orders:list orders:post",
+        },
+    )
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+def unassigned_orders(url: str, token: str, limit: int) -> list:
+    response = requests.get(
+        f"{url}/orders",
+        params={"state": "unassigned", "fields": "", "size": limit},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    response.raise_for_status()
+    return [order["id"] for order in response.json()["items"]]
+
+
+def outcome(response: requests.Response) -> int:
+    # Validation errors of the order endpoints are returned in a 200 body
+    body = response.json()
+    if response.status_code == 200 and "object_id" not in body:
+        return body.get("status_code", 200)
+    return response.status_code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="http://localhost:8082")
+    parser.add_argument(
+        "--user",
+        action="append",
+        required=True,
+        help="username:password of a driver, repeat for several drivers",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="simultaneous accepts per order"
+    )
+    parser.add_argument("--orders", type=int, default=50, help="orders to accept")
+    args = parser.parse_args()
+
+    tokens = [login(args.url, user) for user in args.user]
+    order_ids = unassigned_orders(args.url, tokens[0], args.orders)
+    if not order_ids:
+        sys.exit("No unassigned order to accept")
+
+    outcomes = Counter()
+    winners = Counter()
+    latencies = []
+    lock = threading.Lock()
+
+    def accept(order_id: int, token: str, barrier: threading.Barrier):
+        session = requests.Session()
+        barrier.wait()
+        started = time.perf_counter()
+        response = session.post(
+            f"{args.url}/orders/{order_id}/accept",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        elapsed = time.perf_counter() - started
+        code = outcome(response)
+        with lock:
+            latencies.append(elapsed)
+            outcomes[code] += 1
+            if code == 200:
+                winners[order_id] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for order_id in order_ids:
+            # Release the requests of one order at the same time
+            barrier = threading.Barrier(args.concurrency)
+            futures = [
+                pool.submit(accept, order_id, tokens[i % len(tokens)], barrier)
+                for i in range(args.concurrency)
+            ]
+            for future in futures:
+                future.result()
+    elapsed = time.perf_counter() - started
+
+    requests_count = len(latencies)
+    latencies.sort()
+    print(f"orders:      {len(order_ids)}")
+    print(f"requests:    {requests_count} in {elapsed:.2f}s")
+    print(f"throughput:  {requests_count / elapsed:.1f} req/s")
+    print(
+        "latency ms:  "
+        f"p50={statistics.median(latencies) * 1000:.1f} "
+        f"p95={latencies[int(0.95 * (requests_count - 1))] * 1000:.1f} "
+        f"max={latencies[-1] * 1000:.1f}"
+    )
+    print("outcomes:    " + ", ".join(f"{k}={v}" for k, v in sorted(outcomes.items())))
+    double = [order_id for order_id, count in winners.items() if count > 1]
+    if double:
+        sys.exit(f"Orders accepted more than once: {double}")
+    if outcomes[500]:
+        sys.exit("Some accepts failed with a server error")
+
+
+if __name__ == "__main__":
+    main()
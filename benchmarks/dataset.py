@@ -0,0 +1,222 @@
+"""Deterministic benchmark dataset.
+
+Seeds an Odoo database, which must have `order_dispatch` installed, with
+drivers, customers and their delivery addresses, products, confirmed sale
+orders with their lines and pickings, and chatter messages. The same
+arguments always generate the same data. The database is then used as the
+template of the benchmark runs (see `benchmarks.run`), which work on a copy.
+
+    $ env ODOO_RC=/path/to/odoo.conf python -m benchmarks.dataset --db nextway_bench
+"""
+import argparse
+import json
+import random
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+
+import odoo
+
+from app.dependencies import configure_odoo
+
+# ir.config_parameter storing the generation arguments, read by the runner
+PARAMETER = "nextway_api.benchmark_dataset"
+DRIVER_LOGIN = "bench-driver-{}"
+DRIVER_PASSWORD = "bench-password"
+DRIVER_GROUP = "order_dispatch.dispatch_group_api_driver_user"
+
+
+@dataclass
+class DatasetConfig:
+    seed: int = 0
+    drivers: int = 20
+    partners: int = 500
+    products: int = 50
+    orders: int = 2000
+    lines_per_order: int = 5
+    messages_per_order: int = 5
+    # Share of the orders whose picking is unassigned, assigned to a driver,
+    # or done. The first two are consumed by the accept and drop-off runs.
+    unassigned_ratio: float = 0.4
+    assigned_ratio: float = 0.4
+
+
+def create_drivers(env, config: DatasetConfig):
+    group = env.ref(DRIVER_GROUP)
+    return (
+        env["res.users"]
+        .with_context(no_reset_password=True)
+        .create(
+            [
+                {
+                    "name": f"Bench Driver {i}",
+                    "login": DRIVER_LOGIN.format(i),
+                    "password": DRIVER_PASSWORD,
+                    "groups_id": [(4, group.id)],
+                }
+                for i in range(config.drivers)
+            ]
+        )
+    )
+
+
+def create_partners(env, config: DatasetConfig, rng: random.Random):
+    """Customers, each with a delivery address around Brussels"""
+    country = env.ref("base.be")
+    customers = env["res.partner"].create(
+        [
+            {
+                "name": f"Bench Customer {i}",
+                "street": f"{rng.randint(1, 200)} Rue de la Loi",
+                "city": "Brussels",
+                "zip": "1000",
+                "country_id": country.id,
+                "phone": f"+32 2 {rng.randint(100, 999)} {rng.randint(10, 99)} 00",
+                "partner_latitude": 50.85 + rng.uniform(-0.1, 0.1),
+                "partner_longitude": 4.35 + rng.uniform(-0.15, 0.15),
+            }
+            for i in range(config.partners)
+        ]
+    )
+    env["res.partner"].create(
+        [
+            {
+                "name": f"Bench Delivery {i}",
+                "type": "delivery",
+                "parent_id": customer.id,
+                "street": f"{rng.randint(1, 200)} Avenue Louise",
+                "city": "Brussels",
+                "zip": "1050",
+                "country_id": country.id,
+                "partner_latitude": 50.83 + rng.uniform(-0.1, 0.1),
+                "partner_longitude": 4.36 + rng.uniform(-0.15, 0.15),
+            }
+            for i, customer in enumerate(customers)
+        ]
+    )
+    return customers
+
+
+def create_products(env, config: DatasetConfig, rng: random.Random):
+    return env["product.product"].create(
+        [
+            {
+                "name": f"Bench Product {i}",
+                "detailed_type": "consu",
+                "list_price": round(rng.uniform(1, 100), 2),
+            }
+            for i in range(config.products)
+        ]
+    )
+
+
+def create_orders(env, config: DatasetConfig, rng: random.Random, customers, products):
+    orders = env["sale.order"].create(
+        [
+            {
+                "partner_id": customer.id,
+                "partner_shipping_id": customer.child_ids[:1].id or customer.id,
+                "order_line": [
+                    (
+                        0,
+                        0,
+                        {
+                            "product_id": rng.choice(products).id,
+                            "product_uom_qty": rng.randint(1, 10),
+                        },
+                    )
+                    for __ in range(config.lines_per_order)
+                ],
+            }
+            for customer in (rng.choice(customers) for __ in range(config.orders))
+        ]
+    )
+    orders.action_confirm()
+    orders.picking_ids.action_assign()
+    return orders
+
+
+def dispatch_orders(env, config: DatasetConfig, rng: random.Random, orders, drivers):
+    """Leave some orders unassigned, assign some to drivers and deliver the rest"""
+    unassigned = int(len(orders) * config.unassigned_ratio)
+    assigned = int(len(orders) * config.assigned_ratio)
+    for order in orders[unassigned : unassigned + assigned]:
+        order.picking_ids.write({"user_id": rng.choice(drivers).id})
+    done = orders[unassigned + assigned :]
+    for order in done:
+        order.picking_ids.write({"user_id": rng.choice(drivers).id})
+    for move in done.picking_ids.move_ids:
+        move.quantity_done = move.product_uom_qty
+    done.picking_ids._action_done()
+
+
+def create_messages(env, config: DatasetConfig, rng: random.Random, orders):
+    """Chatter of the orders, with drop-off logs by their driver this month"""
+    start_of_month = datetime.now().replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    values = []
+    for order in orders:
+        driver = order.picking_ids[:1].user_id
+        for i in range(config.messages_per_order):
+            author = driver if driver and i == 0 else env.user
+            values.append(
+                {
+                    "model": "sale.order",
+                    "res_id": order.id,
+                    "message_type": "notification",
+                    "author_id": author.partner_id.id,
+                    "date": start_of_month + timedelta(minutes=rng.randint(0, 600)),
+                    "body": f"Drop off by {author.login} (#{author.id})"
+                    if driver and i == 0
+                    else f"Bench note {i}",
+                }
+            )
+    env["mail.message"].create(values)
+
+
+def generate(env, config: DatasetConfig):
+    Parameter = env["ir.config_parameter"]
+    if Parameter.get_param(PARAMETER):
+        raise SystemExit(f"{env.cr.dbname} already has a benchmark dataset")
+    rng = random.Random(config.seed)
+    drivers = create_drivers(env, config)
+    customers = create_partners(env, config, rng)
+    products = create_products(env, config, rng)
+    orders = create_orders(env, config, rng, customers, products)
+    dispatch_orders(env, config, rng, orders, drivers)
+    create_messages(env, config, rng, orders)
+    Parameter.set_param(PARAMETER, json.dumps(asdict(config)))
+
+
+def load_config(env) -> DatasetConfig:
+    """Arguments the dataset of the database was generated with"""
+    value = env["ir.config_parameter"].sudo().get_param(PARAMETER)
+    if not value:
+        raise SystemExit(
+            f"{env.cr.dbname} has no benchmark dataset, see benchmarks.dataset"
+        )
+    return DatasetConfig(**json.loads(value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", required=True, help="Odoo database to seed")
+    defaults = DatasetConfig()
+    for name, value in asdict(defaults).items():
+        parser.add_argument(
+            f"--{name.replace('_', '-')}", type=type(value), default=value
+        )
+    args = parser.parse_args()
+    config = DatasetConfig(**{name: getattr(args, name) for name in asdict(defaults)})
+    # Read Odoo config from $ODOO_RC.
+    odoo.tools.config.parse_config([])
+    configure_odoo()
+    registry = odoo.registry(args.db)
+    with registry.cursor() as cr:
+        env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+        generate(env, config)
+    print(f"Seeded {args.db}: {asdict(config)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Time of the route sequencing of `GET /orders/route`.
+
+Sequences random stops around a driver, with a cold then a cached distance
+matrix, and fails when the median time exceeds the target:
+
+    $ python -m benchmarks.route_sequencing --stops 200 --target-ms 100
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+
+from app import routing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--stops", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--target-ms", type=float, default=100.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # Stops scattered over a city, about 50 km wide
+    stops = [
+        (50.6 + rng.uniform(-0.2, 0.2), 4.4 + rng.uniform(-0.35, 0.35))
+        for __ in range(args.stops)
+    ]
+    start = (50.6, 4.4)
+
+    timings = {"cold": [], "cached": []}
+    for __ in range(args.runs):
+        for kind in ("cold", "cached"):
+            if kind == "cold":
+                routing.matrix_cache.clear()
+            started = time.perf_counter()
+            visits, legs, optimized = routing.sequence(start, stops)
+            timings[kind].append((time.perf_counter() - started) * 1000)
+    assert sorted(visits) == list(range(args.stops))
+
+    # Nearest neighbour alone, to show what 2-opt gains
+    matrix = routing.route_matrix(start, stops)
+    path = routing.nearest_neighbour(matrix)
+    greedy = float(matrix[path[:-2], path[1:-1]].sum())
+
+    print(f"stops:       {args.stops}")
+    for kind, values in timings.items():
+        print(
+            f"{kind + ' ms:':<12} p50={statistics.median(values):.1f} "
+            f"max={max(values):.1f}"
+        )
+    print(f"distance km: {sum(legs):.1f} (nearest neighbour {greedy:.1f})")
+    print(f"optimized:   {optimized}")
+    if statistics.median(timings["cold"]) > args.target_ms:
+        sys.exit(f"Slower than {args.target_ms} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""Performance regression benchmarks of the API.
+
+Copies the template database seeded by `benchmarks.dataset`, then calls the
+endpoints through the FastAPI test client, in process, as the drivers of
+the dataset. Reports the latency percentiles and the number of SQL queries
+of each scenario, and exits with an error when they regress beyond the
+baselines stored in `benchmarks/baselines.json`, or have none:
+
+    $ env ODOO_RC=/path/to/odoo.conf python -m benchmarks.run --template nextway_bench
+
+Record new baselines, on the reference machine, with `--update-baselines`.
+"""
+import argparse
+import configparser
+import functools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+# Keep the background work of the API from running queries during the
+# measures: Odoo signaling is checked once, and the nearby orders index is
+# loaded once, before them.
+os.environ.setdefault("ODOO_SIGNALING_INTERVAL_SECONDS", "3600")
+os.environ.setdefault("NEARBY_REFRESH_SECONDS", "3600")
+
+import odoo  # noqa: E402
+
+from benchmarks.dataset import DRIVER_LOGIN, DRIVER_PASSWORD, load_config  # noqa: E402
+
+BASELINES = Path(__file__).parent / "baselines.json"
+
+
+class QueryCounter:
+    """Number of SQL queries run by the Odoo cursors of the process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def install(self):
+        execute = odoo.sql_db.Cursor.execute
+
+        @functools.wraps(execute)
+        def counting_execute(cr, *args, **kwargs):
+            with self._lock:
+                self.count += 1
+            return execute(cr, *args, **kwargs)
+
+        odoo.sql_db.Cursor.execute = counting_execute
+
+
+def odoo_rc_for(db_name: str) -> str:
+    """Copy of the Odoo configuration file of $ODOO_RC, on another database"""
+    parser = configparser.ConfigParser()
+    parser.read(os.environ["ODOO_RC"])
+    parser["options"]["db_name"] = db_name
+    rc = tempfile.NamedTemporaryFile("w", suffix=".conf", delete=False)
+    with rc:
+        parser.write(rc)
+    return rc.name
+
+
+def dataset_orders(db_name: str) -> dict:
+    """Orders the mutating scenarios can work on, and the drivers"""
+    registry = odoo.registry(db_name)
+    with registry.cursor() as cr:
+        env = odoo.api.Environment(cr, odoo.SUPERUSER_ID, {})
+        config = load_config(env)
+        logins = [DRIVER_LOGIN.format(i) for i in range(config.drivers)]
+        pickings = env["stock.picking"].search(
+            [("sale_id", "!=", False), ("state", "=", "assigned")], order="id"
+        )
+        return dict(
+            logins=logins,
+            unassigned=pickings.filtered(lambda p: not p.user_id).sale_id.ids,
+            assigned={
+                login: pickings.filtered(lambda p: p.user_id.login == login).sale_id.ids
+                for login in logins
+            },
+        )
+
+
+class Scenarios:
+    """Requests of each scenario. Each call does one request, as the next driver."""
+
+    def __init__(self, client, orders: dict):
+        self.client = client
+        self.orders = orders
+        self.tokens = {}
+        for login in orders["logins"]:
+            response = client.post(
+                "/token",
+                data={
+                    "username": login,
+                    "password": DRIVER_PASSWORD,
+                    "scope": "me_profile orders:list orders:post",
+                },
+            )
+            response.raise_for_status()
+            self.tokens[login] = response.json()["access_token"]
+        self._turn = 0
+
+    def _driver(self):
+        login = self.orders["logins"][self._turn % len(self.orders["logins"])]
+        self._turn += 1
+        return login, {"Authorization": f"Bearer {self.tokens[login]}"}
+
+    def get_current_user(self):
+        return self.client.get("/users/me/", headers=self._driver()[1])
+
+    def list_orders(self):
+        return self.client.get(
+            "/orders/",
+            params={"state": "unassigned", "size": 50},
+            headers=self._driver()[1],
+        )
+
+    def get_order_stats(self):
+        return self.client.get("/users/stats/", headers=self._driver()[1])
+
+    def accept(self):
+        order_id = self.orders["unassigned"].pop()
+        return self.client.post(f"/orders/{order_id}/accept", headers=self._driver()[1])
+
+    def drop_off(self):
+        # A driver with an assigned order left
+        for __ in self.orders["logins"]:
+            login, headers = self._driver()
+            if self.orders["assigned"][login]:
+                break
+        else:
+            raise IndexError("No assigned order left to drop off")
+        order_id = self.orders["assigned"][login].pop()
+        now = datetime.now().isoformat()
+        return self.client.post(
+            f"/orders/{order_id}/drop-off",
+            headers=headers,
+            json={
+                "drop_off_datetime": now,
+                "collection_datetime": now,
+                "message": "Left at the door",
+            },
+        )
+
+
+SCENARIOS = ["get_current_user", "list_orders", "get_order_stats", "accept", "drop_off"]
+
+
+def measure(scenario, counter: QueryCounter, iterations: int, warmup: int) -> dict:
+    latencies, queries = [], []
+    for i in range(warmup + iterations):
+        before = counter.count
+        started = time.perf_counter()
+        response = scenario()
+        elapsed = time.perf_counter() - started
+        body = response.json()
+        # Errors of the order actions are returned in a 200 body
+        if response.status_code != 200 or (
+            isinstance(body, dict) and "status_code" in body
+        ):
+            raise RuntimeError(f"{scenario.__name__}: {response.status_code} {body}")
+        if i >= warmup:
+            latencies.append(elapsed * 1000)
+            queries.append(counter.count - before)
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return dict(
+        p50_ms=round(percentiles[49], 2),
+        p95_ms=round(percentiles[94], 2),
+        p99_ms=round(percentiles[98], 2),
+        queries=int(statistics.median(queries)),
+    )
+
+
+def regressions(results: dict, baselines: dict, tolerance: float) -> list:
+    """Latencies above their baseline by more than `tolerance`, any extra query,
+    and the scenarios without a baseline to compare with"""
+    found = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            found.append(f"{name}: no baseline, record one with --update-baselines")
+            continue
+        if result["p95_ms"] > baseline["p95_ms"] * (1 + tolerance):
+            found.append(f"{name}: p95 {result['p95_ms']} ms > {baseline['p95_ms']} ms")
+        if result["queries"] > baseline["queries"]:
+            found.append(f"{name}: {result['queries']} queries > {baseline['queries']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--template", required=True, help="Database seeded by benchmarks.dataset"
+    )
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed latency increase over the baselines, 0.25 for 25%%",
+    )
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS)
+    parser.add_argument("--update-baselines", action="store_true")
+    args = parser.parse_args()
+
+    # Read Odoo config from $ODOO_RC.
+    odoo.tools.config.parse_config([])
+    run_db = f"{args.template}_run"
+    odoo.service.db.exp_duplicate_database(args.template, run_db)
+    os.environ["ODOO_RC"] = odoo_rc_for(run_db)
+    try:
+        orders = dataset_orders(run_db)
+        counter = QueryCounter()
+        counter.install()
+
+        from fastapi.testclient import TestClient
+
+        from app import geo
+        from app.main import app
+
+        with TestClient(app) as client:
+            while not geo.nearby_orders.ready:
+                time.sleep(0.1)
+            scenarios = Scenarios(client, orders)
+            results = {
+                name: measure(
+                    getattr(scenarios, name), counter, args.iterations, args.warmup
+                )
+                for name in args.scenario or SCENARIOS
+            }
+    finally:
+        odoo.sql_db.close_all()
+        odoo.service.db.exp_drop(run_db)
+        os.unlink(os.environ["ODOO_RC"])
+
+    baselines = json.loads(BASELINES.read_text()) if BASELINES.exists() else {}
+    print(f"{'scenario':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}")
+    for name, result in results.items():
+        baseline = baselines.get(name, {})
+        print(
+            f"{name:<18}{result['p50_ms']:>10}{result['p95_ms']:>10}"
+            f"{result['p99_ms']:>10}{result['queries']:>9}"
+            + (
+                f"   (baseline p95 {baseline['p95_ms']} ms, {baseline['queries']} queries)"
+                if baseline
+                else "   (no baseline)"
+            )
+        )
+    if args.update_baselines:
+        BASELINES.write_text(json.dumps({**baselines, **results}, indent=2) + "\n")
+        print(f"Baselines written to {BASELINES}")
+        return
+    found = regressions(results, baselines, args.tolerance)
+    if found:
+        sys.exit("Regressions:\n" + "\n".join(found))
+
+
+if __name__ == "__main__":
+    main()
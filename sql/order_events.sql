@@ -0,0 +1,40 @@
+-- Notifications of the order events of the API, see app/events.py.
+--
+-- Run once on the Odoo database, by its owner, and again when this file
+-- changes: psql -d <database> -f sql/order_events.sql
+-- The API only listens to them, and warns at startup when they are missing.
+
+-- Ids of the events, shared by every API process
+CREATE SEQUENCE IF NOT EXISTS nextway_api_picking_event_seq;
+
+CREATE OR REPLACE FUNCTION nextway_api_picking_notify() RETURNS trigger AS $$
+DECLARE
+    new_row stock_picking;
+    old_row stock_picking;
+BEGIN
+    IF TG_OP <> 'DELETE' THEN new_row := NEW; END IF;
+    IF TG_OP <> 'INSERT' THEN old_row := OLD; END IF;
+    IF TG_OP <> 'UPDATE'
+        OR NEW.state IS DISTINCT FROM OLD.state
+        OR NEW.user_id IS DISTINCT FROM OLD.user_id
+    THEN
+        PERFORM pg_notify('nextway_api_picking', json_build_object(
+            'event_id', nextval('nextway_api_picking_event_seq'),
+            'id', COALESCE(new_row.id, old_row.id),
+            'sale_id', COALESCE(new_row.sale_id, old_row.sale_id),
+            'exists', TG_OP <> 'DELETE',
+            'state', new_row.state,
+            'user_id', new_row.user_id,
+            'existed', TG_OP <> 'INSERT',
+            'old_state', old_row.state,
+            'old_user_id', old_row.user_id
+        )::text);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS nextway_api_picking_notify ON stock_picking;
+CREATE TRIGGER nextway_api_picking_notify
+AFTER INSERT OR DELETE OR UPDATE OF state, user_id ON stock_picking
+FOR EACH ROW EXECUTE FUNCTION nextway_api_picking_notify();